@@ -0,0 +1,70 @@
+# The engine against the old optimize_text (benchmarks/reference.py).
+#
+# Times both on the documents that matter most: large math-heavy answers in
+# every provider style and the small documents the live-typing endpoints see
+# on every keystroke. Prints the best of several interleaved runs of each and
+# the ratio engine / old; with --max-ratio the run fails when the engine is
+# slower than that on any case. The outputs are compared on the way (code skipping off,
+# as the old function had none).
+#
+#   python benchmarks/baseline.py
+#   python benchmarks/baseline.py --max-ratio 1.0
+import argparse
+import os
+import sys
+import timeit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+from reference import optimize_text as reference
+from suite import build
+
+from text_optimizer import Optimizer, optimize_text
+
+PARAGRAPH = ("The loss \\( L = -\\frac{1}{n} \\sum_i y_i , \\log p_i \\) depends on (x) and [ w^T x = b ] "
+             "while (the model) uses \\[ \\sigma(z) = 1/(1+e^{-z}) \\] for each (y_i). ")
+
+CASES = {
+    "grok 200K": build("grok", 200_000),
+    "chatgpt 200K": build("chatgpt", 200_000),
+    "deepseek 200K": build("deepseek", 200_000),
+    "mixed 2K": (PARAGRAPH * 20)[:2000],
+    "5 lines": "\n".join(PARAGRAPH[index * 40:index * 40 + 60] for index in range(5)),
+    "1 line": PARAGRAPH[:80],
+}
+
+
+# Best time per call of each function; their runs are interleaved so that a
+# slow patch of the machine hits both alike
+def best(functions, text, repeat):
+    number = max(1, min(2000, 200_000 // max(len(text), 1)))
+    times = [[] for _ in functions]
+    for _ in range(repeat):
+        for function, results in zip(functions, times):
+            results.append(timeit.timeit(lambda: function(text), number=number) / number)
+    return [min(results) for results in times]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the engine against the old optimize_text")
+    parser.add_argument("--repeat", type=int, default=9)
+    parser.add_argument("--max-ratio", type=float, help="fail when engine / old is above this on any case")
+    args = parser.parse_args(argv)
+
+    plain = Optimizer(skip_code=False)
+    failed = False
+    for name, text in CASES.items():
+        if plain.run(text) != reference(text):
+            print(f"{name}: output differs from the reference")
+            return 1
+        old, new = best((reference, optimize_text), text, args.repeat)
+        print(f"{name:14} {len(text):>7} chars  old {old * 1e6:10.1f} us  engine {new * 1e6:10.1f} us  "
+              f"{new / old:5.2f}x")
+        if args.max_ratio is not None and new / old > args.max_ratio:
+            print(f"REGRESSION: {name} slower than {args.max_ratio:.2f}x the old function")
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,79 @@
+# Round trips of the desktop app's clipboard daemon, headless.
+#
+# Runs a ClipboardWatcher on the offscreen Qt platform, copies chatbot-style
+# answers to the clipboard one after another and waits for the optimized text
+# to come back. Checks that the clipboard then holds exactly optimize_text of
+# the copy and that writing it back did not start another job, and prints the
+# round-trip latency; with --max-ms the run fails when the 99th percentile is
+# slower than that.
+#
+#   python benchmarks/clipboard.py
+#   python benchmarks/clipboard.py --size 8K --copies 200 --max-ms 50
+import argparse
+import os
+import sys
+import time
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, "..", "pyside-program"))
+from suite import build, parse_size, percentile
+
+from PySide6.QtCore import QEventLoop, QTimer
+from PySide6.QtWidgets import QApplication
+
+from app import ClipboardWatcher
+from text_optimizer import optimize_text
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Latency of clipboard round trips through the daemon")
+    parser.add_argument("--size", default="4K", help="characters per copied answer")
+    parser.add_argument("--copies", type=int, default=100)
+    parser.add_argument("--corpus", default="chatgpt")
+    parser.add_argument("--max-ms", type=float, help="fail when the p99 round trip is slower than this")
+    args = parser.parse_args(argv)
+
+    application = QApplication(sys.argv)
+    clipboard = QApplication.clipboard()
+    watcher = ClipboardWatcher(clipboard)
+    loop = QEventLoop()
+    watcher.optimized.connect(lambda seconds: loop.quit())
+    timer = QTimer()
+    timer.setSingleShot(True)
+    timer.timeout.connect(loop.quit)
+
+    times = []
+    for copy in range(args.copies):
+        text = build(args.corpus, parse_size(args.size), seed=copy)
+        expected = optimize_text(text)
+        start = time.perf_counter()
+        clipboard.setText(text)
+        if expected != text:
+            timer.start(5000)
+            loop.exec()
+            times.append(time.perf_counter() - start)
+        generation = watcher.generation
+        application.processEvents()
+        if clipboard.text() != expected:
+            print(f"copy {copy}: clipboard does not hold the optimized text")
+            return 1
+        if watcher.generation != generation or watcher.job is not None:
+            print(f"copy {copy}: the daemon picked up its own output")
+            return 1
+    watcher.stop()
+
+    if not times:
+        print("no copy needed optimizing")
+        return 1
+    p50, p99 = percentile(times, 0.5) * 1000, percentile(times, 0.99) * 1000
+    print(f"{len(times)} round trips of {args.size} {args.corpus} answers: p50 {p50:.2f} ms  p99 {p99:.2f} ms")
+    if args.max_ms is not None and p99 > args.max_ms:
+        print(f"REGRESSION: p99 round trip over {args.max_ms:.1f} ms")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,118 @@
+# What skipping Markdown code saves on code-heavy transcripts.
+#
+# Optimizes each corpus twice: as the old function did, with the math rules
+# running over everything (Optimizer(skip_code=False)), and with the code
+# index, where they only see the prose between fenced blocks and inline code.
+# Prints the characters the rule stages had to scan, the spans they looked at
+# (calls of Optimizer.replacement, each one a candidate a rule matched) and
+# the median wall time. Checks on the way that code comes out as it went in.
+#
+#   python benchmarks/code_regions.py
+#   python benchmarks/code_regions.py --size 1M --corpus transcript --repeat 20
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+from suite import SYMBOLS, WORDS, build, formula, parse_size, prose
+
+from text_optimizer import Optimizer
+from text_optimizer.engine import sanitize
+
+SNIPPETS = ("x[i]", "f(x)", "arr[(i + 1) % n]", "\\(", "$PATH", "dict[key]", "np.dot(w, x)")
+
+
+class CountingOptimizer(Optimizer):
+    def __init__(self, skip_code):
+        super().__init__(skip_code=skip_code)
+        self.calls = 0
+
+    def replacement(self, rule, raw):
+        self.calls += 1
+        return super().replacement(rule, raw)
+
+
+# A chatbot answer about code: explanation with formulas and `inline code`,
+# then a listing, sometimes LaTeX inside a docstring
+def transcript(rng):
+    parts = [prose(rng, rng.randint(8, 20))]
+    for _ in range(rng.randint(1, 4)):
+        parts.append(" `%s` " % rng.choice(SNIPPETS))
+        parts.append(prose(rng, rng.randint(4, 12)))
+        if rng.random() < 0.5:
+            parts.append(" \\( %s \\) " % rng.choice(SYMBOLS))
+    parts.append("\n\n[\n" + formula(rng) + "\n]\n\n")
+    fence = rng.choice(("```python", "```", "~~~"))
+    lines = [fence]
+    for _ in range(rng.randint(4, 16)):
+        name = rng.choice(WORDS)
+        lines.append("    %s = weights[(i, j)] * (x[k] + b)  # [%s]" % (name, rng.choice(WORDS)))
+    if rng.random() < 0.3:
+        lines.append('    """Computes \\( %s \\) and \\[ %s \\]."""' % (rng.choice(SYMBOLS), formula(rng)))
+    lines.append(fence[:3])
+    return "".join(parts) + "\n".join(lines) + "\n\n"
+
+
+def corpus(name, size):
+    if name != "transcript":
+        return build(name, size)
+    rng = random.Random(0)
+    parts = []
+    length = 0
+    while length < size:
+        part = transcript(rng)
+        parts.append(part)
+        length += len(part)
+    return "".join(parts)[:size]
+
+
+def timed(optimizer, text, repeat):
+    optimizer.run(text)  # warm-up
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        optimizer.run(text)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rule work and wall time with and without the code index")
+    parser.add_argument("--size", default="256K")
+    parser.add_argument("--corpus", action="append", help="transcript, code_heavy or a suite corpus (repeatable)")
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    size = parse_size(args.size)
+    failed = False
+    for name in args.corpus or ["transcript", "code_heavy", "chatgpt"]:
+        text = corpus(name, size)
+        clean = sanitize(text)
+        old, new = CountingOptimizer(skip_code=False), CountingOptimizer(skip_code=True)
+        output = new.run(text)
+        segments = new.code_segments(clean)
+        code = [piece for is_code, piece in segments if is_code]
+        prose_chars = len(clean) - sum(len(piece) for piece in code)
+        # the line cleanup still drops trailing blanks, in code as anywhere
+        missing = [line for piece in code for line in piece.split("\n") if line.rstrip(" \t") not in output]
+        if missing:
+            print(f"{name}: code changed in the output: {missing[0][:60]!r}")
+            failed = True
+        old_time, new_time = timed(old, text, args.repeat), timed(new, text, args.repeat)
+        old.calls = new.calls = 0
+        old.run(text)
+        new.run(text)
+        print(f"{name:11} {len(text):>9} chars, {len(code)} code regions")
+        print(f"  scanned by rules   {len(clean):>10} -> {prose_chars:>10} chars")
+        print(f"  spans looked at    {old.calls:>10} -> {new.calls:>10}  ({old.calls - new.calls} fewer)")
+        print(f"  median wall time   {old_time * 1000:>9.2f}ms -> {new_time * 1000:>8.2f}ms  "
+              f"({old_time / new_time:.2f}x)")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,85 @@
+# Differential check of the engine against the old optimize_text.
+#
+# Runs random documents over small alphabets dense in delimiters and corner
+# cases (unclosed spans, \big], $$ regions, unprintable characters, stray
+# halves of two-character delimiters), the suite corpora and the
+# pathological inputs through benchmarks/reference.py and through the engine
+# with code skipping off, the way the old function worked, both in one call
+# and streamed in random chunks. The default optimizer has to agree too on
+# documents without Markdown code. Fails on the first difference and prints
+# the document.
+#
+#   python benchmarks/equivalence.py
+#   python benchmarks/equivalence.py --documents 100000 --seed 7
+import argparse
+import os
+import random
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+from pathological import CORPUS
+from reference import optimize_text as reference
+from suite import CORPORA, build
+
+from text_optimizer import Optimizer, StreamingOptimizer, optimize_text
+
+ALPHABETS = (
+    list("ab x_1 (y) [z] \\( \\) \\[ \\] $$ $ \\big] ;=; ; , \\log \n\n  \t\x07é AB {}^=<>"),
+    list("([\\$)] \n_x"),
+    ["\\(", "\\)", "\\[", "\\]", "(", ")", "[", "]", "$$", "$", "\\big]", " ", "\n", "x_1", "\\sum", " , \\log", "é😀"],
+)
+
+
+def differences(plain, text, rng):
+    expected = reference(text)
+    if plain.run(text) != expected:
+        return "run"
+    if "`" not in text and "~~~" not in text and optimize_text(text) != expected:
+        return "default optimizer"
+    streaming = StreamingOptimizer(plain)
+    output = []
+    pos = 0
+    while pos < len(text):
+        size = rng.randint(1, 24)
+        output.append(streaming.feed(text[pos:pos + size]))
+        pos += size
+    output.append(streaming.flush())
+    if "".join(output) != expected:
+        return "streaming"
+    return None
+
+
+def documents(count, rng):
+    for _ in range(count):
+        alphabet = rng.choice(ALPHABETS)
+        yield "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 160)))
+    for name in CORPORA:
+        for size in (1, 100, 1000, 20000):
+            yield build(name, size, seed=rng.randrange(1000))
+    for make in CORPUS.values():
+        for units in (1, 7, 50):
+            yield make(units)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare the engine with the old optimize_text")
+    parser.add_argument("--documents", type=int, default=20000, help="random documents to try")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    plain = Optimizer(skip_code=False)
+    count = 0
+    for text in documents(args.documents, rng):
+        failed = differences(plain, text, rng)
+        if failed:
+            print(f"{failed} differs from the reference for {text!r}")
+            return 1
+        count += 1
+    print(f"{count} documents identical to the reference")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,63 @@
+# UI time and memory of the desktop output pane under repeated edits.
+#
+# Builds the window offscreen, shows a large optimized document, then edits
+# one line of the input over and over and applies every result the way the
+# window does. Prints the time per applied result and the resident memory
+# after every round; with the minimal-diff output it should stay flat.
+#
+#   python benchmarks/output_view.py
+#   python benchmarks/output_view.py --size 8M --rounds 20
+import argparse
+import os
+import sys
+import time
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, "..", "pyside-program"))
+from suite import build, parse_size
+
+from PySide6.QtWidgets import QApplication
+
+from app import TextOptimizerWindow
+from text_optimizer import optimize_text
+
+
+def resident_bytes():
+    with open("/proc/self/statm") as file:
+        return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time and memory of the output pane under repeated edits")
+    parser.add_argument("--size", default="4M", help="characters in the document")
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--corpus", default="deepseek")
+    args = parser.parse_args(argv)
+
+    application = QApplication(sys.argv)
+    window = TextOptimizerWindow(debounce_ms=0)
+    window.show()
+    text = build(args.corpus, parse_size(args.size))
+    start = time.perf_counter()
+    window.apply([optimize_text(text)])
+    application.processEvents()
+    print(f"first document {(time.perf_counter() - start) * 1000:9.1f} ms  "
+          f"view {type(window.outputs.currentWidget()).__name__}")
+
+    middle = len(text) // 2
+    for round in range(args.rounds):
+        edited = text[:middle] + "edit %d \\(x_%d\\) " % (round, round) + text[middle:]
+        output = optimize_text(edited)
+        start = time.perf_counter()
+        window.apply([output])
+        application.processEvents()
+        elapsed = time.perf_counter() - start
+        print(f"round {round:3}  apply {elapsed * 1000:9.2f} ms  resident {resident_bytes() / 1e6:8.1f} MB", flush=True)
+    window.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,96 @@
+# ParallelOptimizer against optimize_text on single large documents.
+#
+# For every corpus of the suite (plus one with a stray "(" near the start,
+# which keeps a span open across every cut), checks that the output is the
+# same as optimize_text for each worker count, also on the command line's
+# path for large files (chunks of UTF-8 bytes written out as they are done,
+# see cli.write_parallel), then times both and prints the
+# speedup. The run fails when the largest worker count is less than
+# --min-speedup times as fast as sequential on a corpus without open spans
+# (by default half the worker count). The speedup is only checked when the
+# machine has a core for every worker; with fewer it is printed, not gated.
+#
+#   python benchmarks/parallel.py
+#   python benchmarks/parallel.py --size 50M --workers 1,2,4,8 --min-speedup 2.5
+import argparse
+import io
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from suite import CORPORA, build, parse_size
+
+from text_optimizer import ParallelOptimizer, optimize_text
+from text_optimizer.cli import write_parallel
+
+
+def corpus(name, size):
+    if name == "stray_paren":
+        return "(" + build("grok", size - 1)
+    return build(name, size)
+
+
+def file_output(text, workers):
+    out = io.BytesIO()
+    with ProcessPoolExecutor(workers) as executor:
+        write_parallel(executor, workers, text.encode("utf-8", "surrogatepass"), out)
+    return out.getvalue().decode("utf-8")
+
+
+def best_time(function, text, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(text)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Verify and time ParallelOptimizer on single documents")
+    parser.add_argument("--size", default="8M", help="characters per document, e.g. 8M")
+    parser.add_argument("--workers", default="1,2,4", help="comma-separated worker counts")
+    parser.add_argument("--corpus", action="append", choices=CORPORA + ["stray_paren"])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--min-speedup", type=float,
+                        help="fail below this speedup at the largest worker count (default: half of it)")
+    args = parser.parse_args(argv)
+
+    size = parse_size(args.size)
+    counts = [int(count) for count in args.workers.split(",")]
+    min_speedup = args.min_speedup or max(counts) / 2
+    cores = os.cpu_count() or 1
+    gated = cores >= max(counts)
+    if not gated:
+        print(f"speedup not checked: {cores} cores for {max(counts)} workers")
+    failed = False
+    for name in args.corpus or CORPORA + ["stray_paren"]:
+        text = corpus(name, size)
+        expected = optimize_text(text)
+        sequential = best_time(optimize_text, text, args.repeat)
+        line = f"{name:12} sequential {sequential * 1000:9.1f} ms"
+        for count in counts:
+            optimizer = ParallelOptimizer(workers=count, min_size=0)
+            if optimizer.run(text) != expected:
+                print(f"{name}: output with {count} workers differs from optimize_text")
+                return 1
+            if file_output(text, count) != expected:
+                print(f"{name}: file output with {count} workers differs from optimize_text")
+                return 1
+            elapsed = best_time(optimizer.run, text, args.repeat)
+            optimizer.close()
+            speedup = sequential / elapsed
+            line += f"  {count}w {elapsed * 1000:9.1f} ms {speedup:5.2f}x"
+            if gated and count == max(counts) and name != "stray_paren" and speedup < min_speedup:
+                failed = True
+        print(line, flush=True)
+    if failed:
+        print(f"speedup below {min_speedup}x with {max(counts)} workers")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,91 @@
+# Adversarial inputs for the bracket/paren math heuristics.
+#
+# The old regexes (r"\(\s*([\s\S]*?)\s*\)" and friends) rescanned the rest of
+# the document for every unmatched opener, so a paste with many stray "(" or
+# "[" took quadratic time. Every case below is timed at doubling sizes and the
+# growth exponent is fitted on a log-log scale; the run fails when a case grows
+# faster than linear.
+#
+#   python benchmarks/pathological.py
+#   python benchmarks/pathological.py --units 10000 --max-exponent 1.3
+import argparse
+import math
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from text_optimizer import optimize_text
+
+# name -> function building the input from a number of repeated units
+CORPUS = {
+    "unmatched_parens": lambda n: "(" * n + " tail",
+    "unmatched_brackets": lambda n: "[" * n + " tail",
+    "unmatched_latex_inline": lambda n: "\\( x " * n,
+    "unmatched_latex_display": lambda n: "\\[ x " * n,
+    "unmatched_mixed_latex": lambda n: "\\( \\[ " * n,
+    "deep_paren_nesting": lambda n: "(" * n + "x" + ")" * n,
+    "deep_bracket_nesting": lambda n: "[" * n + "x = 1" + "]" * n,
+    "big_closers_only": lambda n: "[ a " + "\\big]" * n,
+    "whitespace_in_parens": lambda n: "(" + " " * n + "x" * n,
+    "whitespace_in_brackets": lambda n: "[" + " \n" * n + "x",
+    "parens_across_display": lambda n: "( a $$ " * n,
+    "dollar_runs": lambda n: "$" * n + "(x)",
+    "code_listing": lambda n: "if (a[i] > f(b[j]) {\n" * n,
+    "log_dump": lambda n: "[INFO] worker(3) started [pid 42\n" * n,
+    "many_small_spans": lambda n: "(x) [a=b] \\(y\\) " * n,
+}
+
+
+def best_time(text, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        optimize_text(text)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+# Least-squares slope of log(time) against log(size)
+def growth_exponent(sizes, times):
+    xs = [math.log(s) for s in sizes]
+    ys = [math.log(max(t, 1e-9)) for t in times]
+    mean_x = sum(xs) / len(xs)
+    mean_y = sum(ys) / len(ys)
+    num = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys))
+    den = sum((x - mean_x) ** 2 for x in xs)
+    return num / den
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Adversarial scaling benchmark for optimize_text")
+    parser.add_argument("--units", type=int, default=10_000, help="units in the smallest input")
+    parser.add_argument("--steps", type=int, default=4, help="number of doublings")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--max-exponent", type=float, default=1.3,
+                        help="fail when a case grows faster than n**max_exponent")
+    parser.add_argument("--case", action="append", choices=sorted(CORPUS), help="only run these cases")
+    args = parser.parse_args(argv)
+
+    failed = []
+    for name in args.case or CORPUS:
+        build = CORPUS[name]
+        sizes, times = [], []
+        for step in range(args.steps):
+            text = build(args.units << step)
+            sizes.append(len(text))
+            times.append(best_time(text, args.repeat))
+        exponent = growth_exponent(sizes, times)
+        status = "ok" if exponent <= args.max_exponent else "SUPERLINEAR"
+        if status != "ok":
+            failed.append(name)
+        print(f"{name:26} {sizes[-1]:>10} chars {times[-1] * 1000:9.2f} ms  exponent {exponent:5.2f}  {status}")
+
+    if failed:
+        print("superlinear cases: " + ", ".join(failed))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
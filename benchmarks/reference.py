@@ -0,0 +1,93 @@
+# The optimize_text the apps shipped before text_optimizer, verbatim: five
+# regex passes with lazy patterns. Kept as the reference the engine has to
+# match (benchmarks/equivalence.py) and to time it against
+# (benchmarks/baseline.py). Do not fix anything here.
+import re
+def optimize_text(raw_text):
+    # Remove unprintable characters, allow newlines, tabs, and spaces for indentation
+    cleaned = "".join(c for c in raw_text if c.isprintable() or c in "\n\t ")
+    
+    # Function to process math content: strip whitespace, fix artifacts, escape underscores
+    def process_math_content(content):
+        content = content.strip()
+        # Fix common copy-paste artifacts from ChatGPT-like content
+        content = content.replace(" ;=; ", " = ")
+        content = content.replace(";", "=")  # Clean up any leftover semicolons in equations
+        # Remove commas that are likely typos in math expressions (e.g., y_i , \log -> y_i \log)
+        content = re.sub(r'(\w|\}|\d)\s*,\s*(\\log|\\sum|\\frac|\\big)', r'\1 \2', content)
+        # Escape underscores for Markdown compatibility
+        escaped_content = content.replace("_", "\\_")
+        return escaped_content
+    
+    # Function to replace standard LaTeX math delimiters (used in Grok-like content)
+    def replace_latex_math(match):
+        if match.group(1) is not None:  # Inline math
+            content = process_math_content(match.group(1))
+            return f"${content}$"
+        elif match.group(2) is not None:  # Display math
+            content = process_math_content(match.group(2))
+            return f"$${content}$$"
+    
+    # First, handle standard LaTeX delimiters (\( \), \[ \])
+    pattern_latex = re.compile(r"\\\((.*?)\\\)|\\\[([\s\S]*?)\\\]", re.DOTALL)
+    optimized = re.sub(pattern_latex, replace_latex_math, cleaned)
+    
+    # Now, handle ChatGPT-style display math: [ math ]
+    def replace_display_chatgpt(match):
+        content = match.group(1)
+        # Check if content likely contains math (e.g., LaTeX commands, symbols)
+        if re.search(r'\\[a-zA-Z]+|_|\^|\{|\}|=|<|>|\\in|\\sum|\\log|\\big|\\hat|\\frac', content):
+            content = process_math_content(content)
+            return f"$${content}$$"
+        else:
+            # If not math, leave unchanged
+            return match.group(0)
+    
+    pattern_display = re.compile(r"\[\s*([\s\S]*?)\s*(?<!\\big)\]", re.DOTALL)
+    optimized = re.sub(pattern_display, replace_display_chatgpt, optimized)
+    
+    # Handle ChatGPT-style inline math: ( math )
+    def replace_inline_chatgpt(match):
+        content = match.group(1)
+        # Skip if too long or empty
+        if len(content) > 100 or not content.strip():
+            return match.group(0)
+        # Skip if already processed (contains $)
+        if '$' in content:
+            return match.group(0)
+        # Skip abbreviations like (CE)
+        stripped_content = content.strip()
+        if stripped_content.isupper() and len(stripped_content) > 1:
+            return match.group(0)
+        # Check if likely math: either has specific math symbols or is short single-word (e.g., variables like y, k)
+        has_math_symbols = re.search(r'\\[a-zA-Z]+|_|\^|\{|\}|=|<|>|\\in|\\sum|\\log|\\big|\\hat|\\frac', content)
+        is_short_variable = (len(content.split()) == 1 and len(content) < 10)
+        if has_math_symbols or is_short_variable:
+            content = process_math_content(content)
+            return f"${content}$"
+        else:
+            # If not math, leave unchanged
+            return match.group(0)
+    
+    pattern_inline = re.compile(r"\(\s*([\s\S]*?)\s*\)", re.DOTALL)
+    
+    # Apply inline replacement only outside of $$ ... $$
+    parts = re.split(r'(\$\$)', optimized)
+    is_math = False
+    optimized_parts = []
+    for part in parts:
+        if part == '$$':
+            is_math = not is_math
+            optimized_parts.append(part)
+        else:
+            if not is_math:
+                part = re.sub(pattern_inline, replace_inline_chatgpt, part)
+            optimized_parts.append(part)
+    optimized = ''.join(optimized_parts)
+    
+    # Split into lines, remove trailing whitespace, preserve blank lines
+    lines = optimized.splitlines()
+    optimized_lines = [line.rstrip() for line in lines]
+    
+    # Join lines and remove trailing newlines
+    return "\n".join(optimized_lines).rstrip()
@@ -0,0 +1,79 @@
+# The sanitize stage against the character filter it replaces.
+#
+# First checks that sanitize() keeps and drops exactly what
+# "".join(c for c in text if c.isprintable() or c in "\n\t ") does, for every
+# code point on its own, after ASCII and after non-ASCII text, and in blocks;
+# then times both on clean and dirty ASCII and non-ASCII documents.
+#
+#   python benchmarks/sanitize.py
+#   python benchmarks/sanitize.py --size 4000000 --skip-verify
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from text_optimizer.engine import KEEP_WHITESPACE, sanitize
+
+
+def character_filter(text):
+    return "".join(c for c in text if c.isprintable() or c in KEEP_WHITESPACE)
+
+
+# Code points where sanitize() differs from the character filter
+def mismatches():
+    failed = []
+    for code in range(sys.maxunicode + 1):
+        char = chr(code)
+        expected = char if char.isprintable() or char in KEEP_WHITESPACE else ""
+        if (sanitize(char) != expected or sanitize("a\n" + char) != "a\n" + expected
+                or sanitize("é\t" + char + "\n") != "é\t" + expected + "\n"):
+            failed.append(code)
+    for start in range(0, sys.maxunicode + 1, 4096):
+        block = "".join(map(chr, range(start, min(start + 4096, sys.maxunicode + 1))))
+        if sanitize(block) != character_filter(block):
+            failed.append(start)
+    return failed
+
+
+CORPUS = {
+    "clean_ascii": "Let (x_i) be \\(a^2\\) and [ \\sum_k k ] here.\n\tindented line\n",
+    "dirty_ascii": "Let (x_i) be \\(a^2\\)\x07 and [ \\sum_k k ]\x1b here.\n\tindented line\n",
+    "clean_unicode": "Soit (x_i) é ∑ α — 数学 \\(a^2\\) “quoted” text.\n",
+    "dirty_unicode": "Soit (x_i) é ∑ α​ 数学 \\(a^2\\)\x07 “quoted” text.\n",
+}
+
+
+def best_time(function, text, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(text)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Verify and time the sanitize stage")
+    parser.add_argument("--size", type=int, default=1_000_000, help="characters per document")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--skip-verify", action="store_true", help="only time, skip the full Unicode range check")
+    args = parser.parse_args(argv)
+
+    if not args.skip_verify:
+        failed = mismatches()
+        if failed:
+            print("sanitize differs from the character filter at: " + ", ".join("U+%04X" % code for code in failed[:20]))
+            return 1
+        print("sanitize matches the character filter on all %d code points" % (sys.maxunicode + 1))
+
+    for name, unit in CORPUS.items():
+        text = (unit * (args.size // len(unit) + 1))[:args.size]
+        old = best_time(character_filter, text, args.repeat)
+        new = best_time(sanitize, text, args.repeat)
+        print(f"{name:14} filter {old * 1000:9.2f} ms  sanitize {new * 1000:8.2f} ms  {old / new:6.1f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,58 @@
+# Cold start of the desktop app: process launch to first paint.
+#
+# Starts pyside-program/app.py (or a built executable) with the offscreen Qt
+# platform and OPTIMIZER_EXIT_AFTER_PAINT=1, which makes the window quit as
+# soon as it has been drawn, and times the whole process. Also times
+# importing the optimizer engine on its own, which must not pull in Qt. With
+# --max-ms the run fails when the median startup is slower than that.
+#
+#   python benchmarks/startup.py
+#   python benchmarks/startup.py --executable pyside-program/dist/app/app --max-ms 800
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def launch(command, env):
+    start = time.perf_counter()
+    subprocess.run(command, env=env, check=True, stdout=subprocess.DEVNULL, timeout=60)
+    return time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time from process launch to first paint of the desktop app")
+    parser.add_argument("--executable", help="a built app to run instead of pyside-program/app.py")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--max-ms", type=float, help="fail when the median startup is slower than this")
+    args = parser.parse_args(argv)
+
+    env = dict(os.environ, QT_QPA_PLATFORM="offscreen", OPTIMIZER_EXIT_AFTER_PAINT="1")
+
+    engine = [sys.executable, "-c", "import sys, text_optimizer; sys.exit('PySide6' in sys.modules)"]
+    engine_env = dict(env, PYTHONPATH=ROOT)
+    launch(engine, engine_env)  # the engine must import without Qt
+    baseline = [sys.executable, "-c", "pass"]
+    interpreter = statistics.median(launch(baseline, env) for _ in range(args.repeat))
+    imports = statistics.median(launch(engine, engine_env) for _ in range(args.repeat))
+    print(f"interpreter     {interpreter * 1000:8.1f} ms")
+    print(f"engine import   {(imports - interpreter) * 1000:8.1f} ms  (without Qt)")
+
+    command = [args.executable] if args.executable else [sys.executable, os.path.join(ROOT, "pyside-program", "app.py")]
+    launch(command, env)  # warm the file cache
+    times = sorted(launch(command, env) for _ in range(args.repeat))
+    median = statistics.median(times)
+    print(f"first paint     {median * 1000:8.1f} ms median  {times[0] * 1000:8.1f} ms best  "
+          f"{times[-1] * 1000:8.1f} ms worst")
+    if args.max_ms is not None and median * 1000 > args.max_ms:
+        print(f"REGRESSION: startup median {median * 1000:.1f} ms over {args.max_ms:.1f} ms")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,352 @@
+# Throughput and latency of optimize_text on realistic corpora, with a
+# regression gate.
+#
+# Every corpus is generated deterministically in the style of one provider
+# (or taken from the Markdown files in this repo) and cut to each size. For
+# every corpus and size the suite measures the whole optimize_text call
+# (latency percentiles, MB/s, peak memory) and each pipeline stage on its own:
+# a stage is fed the complete output of the stages before it (the rule stages
+# only its prose, as the pipeline does), so its numbers do not include the
+# others. Results are written as JSON; given a baseline from an earlier run,
+# any case that got slower by more than the threshold fails the run.
+#
+# The gate does not compare medians, which drift by half and more on a
+# shared machine within seconds. The runs of every case are made in rounds,
+# each between runs of a fixed workload (the old function, on a fixed text),
+# and the gate compares the fastest run in units of the fastest run of that
+# workload, which comes out within a few percent from one run of the suite
+# to the next. Now and then one measurement still catches the machine at a
+# bad moment, so a case found slower is measured again (--confirm times) and
+# only fails if it was slower every time, and --runs measures every case
+# several times and keeps the median, which is how the baseline should be
+# written. Cases that got slower by no more than --min-delta-ms are never
+# failed: on the 1K inputs a run takes a fraction of a millisecond, and any
+# jitter looks like a large ratio. benchmarks/suite_baseline.json is a
+# reference run with the default corpora and sizes (--runs 5); regenerate it
+# when comparing on a different kind of machine.
+#
+#   python benchmarks/suite.py --output results.json --runs 5
+#   python benchmarks/suite.py --baseline benchmarks/suite_baseline.json --threshold 0.2
+#   python benchmarks/suite.py --sizes 1K,1M,50M --corpus grok --corpus math_dense
+#   python benchmarks/suite.py --full
+import argparse
+import glob
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+from text_optimizer import default_optimizer, optimize_text
+from text_optimizer.engine import Collector, LineStage, SanitizeStage, run_segments
+
+from reference import optimize_text as reference_optimize_text
+
+DEFAULT_SIZES = "1K,10K,100K,1M"
+FULL_SIZES = "1K,10K,100K,1M,10M,50M"
+UNITS = {"K": 1024, "M": 1024 * 1024}
+
+# The fixed workload the gated times are measured against: the old function
+# on this much of the grok corpus, best of this many runs
+CALIBRATION_SIZE = 8 * 1024
+CALIBRATION_RUNS = 5
+
+WORDS = ("the of and to in is that for it as with was on be by this are or from at which an we can "
+         "value model function result error term sample gradient loss weight vector matrix").split()
+SYMBOLS = ("x", "y_i", "\\alpha", "\\beta", "\\theta_k", "w^T", "n", "k", "\\hat{y}", "\\sigma(z)")
+
+
+def prose(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def formula(rng):
+    terms = [rng.choice(SYMBOLS) for _ in range(rng.randint(2, 5))]
+    kind = rng.randrange(4)
+    if kind == 0:
+        return "\\sum_{i=1}^{n} " + " + ".join(terms)
+    if kind == 1:
+        return "\\frac{" + terms[0] + "}{" + terms[-1] + "} = " + " \\cdot ".join(terms[1:])
+    if kind == 2:
+        return "L = -\\frac{1}{n} \\sum_i y_i , \\log " + terms[0] + " ; " + terms[-1]
+    return " = ".join(terms)
+
+
+# Grok: standard LaTeX delimiters
+def grok(rng):
+    parts = []
+    for _ in range(rng.randint(2, 5)):
+        parts.append(prose(rng, rng.randint(5, 15)) + " \\( " + formula(rng) + " \\) ")
+    parts.append("\n\n\\[\n" + formula(rng) + "\n\\]\n\n")
+    return "".join(parts)
+
+
+# ChatGPT: bare [ ] on their own lines and ( ) inline, plus ordinary parentheses
+def chatgpt(rng):
+    parts = []
+    for _ in range(rng.randint(2, 5)):
+        parts.append(prose(rng, rng.randint(5, 15)) + " ( " + rng.choice(SYMBOLS) + " ) ")
+        if rng.random() < 0.5:
+            parts.append("(" + prose(rng, 4) + ") ")
+    parts.append("\n\n[\n" + formula(rng) + "\n]\n\n")
+    return "".join(parts)
+
+
+# DeepSeek: a mix of every delimiter, including text already in $ and $$
+def deepseek(rng):
+    choice = rng.randrange(5)
+    text = prose(rng, rng.randint(5, 20))
+    if choice == 0:
+        return text + " $" + formula(rng) + "$ "
+    if choice == 1:
+        return text + "\n\n$$\n" + formula(rng) + "\n$$\n\n"
+    if choice == 2:
+        return text + " \\(" + formula(rng) + "\\) "
+    if choice == 3:
+        return text + " [ " + formula(rng) + " ] (" + rng.choice(SYMBOLS) + ") "
+    return text + " (" + prose(rng, 3) + ").  \n"
+
+
+# Prose with code listings full of brackets and parentheses
+def code_heavy(rng):
+    lines = ["```python"]
+    for _ in range(rng.randint(3, 10)):
+        name = rng.choice(WORDS)
+        lines.append("    %s[i] = f(%s[j], (a + b) * c[k])  " % (name, rng.choice(WORDS)))
+    lines.append("```")
+    return prose(rng, rng.randint(10, 30)) + "\n\n" + "\n".join(lines) + "\n\n"
+
+
+# Back-to-back equations with little prose
+def math_dense(rng):
+    return "\\[ " + formula(rng) + " \\] \\( " + formula(rng) + " \\) [ " + formula(rng) + " ] "
+
+
+def curated_units():
+    texts = []
+    for path in sorted(glob.glob(os.path.join(ROOT, "**", "*.md"), recursive=True)):
+        with open(path, encoding="utf-8") as file:
+            texts.append(file.read())
+    return texts
+
+
+GENERATORS = {
+    "grok": grok,
+    "chatgpt": chatgpt,
+    "deepseek": deepseek,
+    "code_heavy": code_heavy,
+    "math_dense": math_dense,
+}
+CORPORA = sorted(GENERATORS) + ["curated"]
+
+
+def build(name, size, seed=0):
+    if name == "curated":
+        units = curated_units()
+        rng = random.Random(seed)
+        unit = lambda rng: rng.choice(units)
+    else:
+        rng = random.Random(seed)
+        unit = GENERATORS[name]
+    parts = []
+    length = 0
+    while length < size:
+        part = unit(rng)
+        parts.append(part)
+        length += len(part)
+    return "".join(parts)[:size]
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    if text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+def run_stage(factory, text):
+    collector = Collector()
+    stage = factory(collector)
+    stage.feed(text)
+    stage.flush()
+    return collector.text()
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+# Seconds of the fixed workload right now
+def calibration(text):
+    best = float("inf")
+    for _ in range(CALIBRATION_RUNS):
+        start = time.perf_counter()
+        reference_optimize_text(text)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+# Latency of repeat runs in each of rounds rounds. With a calibration text,
+# the fixed workload is timed before and after every round, and relative is
+# the fastest run in units of its fastest run
+def measure(function, text, repeat, rounds=1, calibration_text=None):
+    function(text)  # warm-up
+    times = []
+    calibrations = []
+    for _ in range(rounds):
+        if calibration_text is not None:
+            calibrations.append(calibration(calibration_text))
+        for _ in range(repeat):
+            start = time.perf_counter()
+            function(text)
+            times.append(time.perf_counter() - start)
+        if calibration_text is not None:
+            calibrations.append(calibration(calibration_text))
+    tracemalloc.start()
+    function(text)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    median = percentile(times, 0.5)
+    megabytes = len(text.encode("utf-8", "surrogatepass")) / 1e6
+    result = {
+        "p50_ms": round(median * 1000, 4),
+        "best_ms": round(min(times) * 1000, 4),
+        "p90_ms": round(percentile(times, 0.9) * 1000, 4),
+        "p99_ms": round(percentile(times, 0.99) * 1000, 4),
+        "mb_per_s": round(megabytes / median, 3) if median else None,
+        "peak_bytes": peak,
+    }
+    if calibrations:
+        result["relative"] = round(min(times) / min(calibrations), 6)
+    return result
+
+
+# Enough repetitions for stable percentiles without spending minutes on 50 MB
+def repetitions(size, repeat):
+    return max(3, min(repeat, int(repeat * 64 * 1024 / max(size, 1))))
+
+
+# The whole optimize_text call on text, measured runs times; the
+# measurement with the median relative time stands for all of them
+def measure_total(text, repeat, rounds, runs=1):
+    calibration_text = build("grok", CALIBRATION_SIZE)
+    totals = [measure(optimize_text, text, repetitions(len(text), repeat), rounds, calibration_text)
+              for _ in range(runs)]
+    return sorted(totals, key=lambda total: total["relative"])[len(totals) // 2]
+
+
+def run(corpora, sizes, repeat, rounds, runs=1):
+    stages = default_optimizer.stages(lines=False, sanitize=False)
+    results = {}
+    for name in corpora:
+        for size in sizes:
+            text = build(name, size)
+            count = repetitions(size, repeat)
+            # Only the totals are gated, so only they get several rounds and runs
+            entry = {"chars": len(text), "repeat": count, "rounds": rounds, "runs": runs,
+                     "total": measure_total(text, repeat, rounds, runs), "stages": {}}
+            entry["stages"]["sanitize"] = measure(lambda piece: run_stage(SanitizeStage, piece), text, count)
+            clean = run_stage(SanitizeStage, text)
+            entry["stages"]["code"] = measure(default_optimizer.code_segments, clean, count)
+            segments = default_optimizer.code_segments(clean)
+            for stage_name, factory in stages:
+                stage_input = "".join(piece for _, piece in segments)
+                entry["stages"][stage_name] = measure(lambda piece: run_segments(factory, segments), stage_input, count)
+                segments = run_segments(factory, segments)
+            stage_input = "".join(piece for _, piece in segments)
+            entry["stages"]["lines"] = measure(lambda piece: run_stage(LineStage, piece), stage_input, count)
+            results["%s/%d" % (name, size)] = entry
+            total = entry["total"]
+            print(f"{name:11} {size:>10} B  p50 {total['p50_ms']:10.3f} ms  p99 {total['p99_ms']:10.3f} ms  "
+                  f"{total['mb_per_s']:8.2f} MB/s  peak {total['peak_bytes'] / 1e6:8.2f} MB", flush=True)
+    return results
+
+
+# Cases whose fastest run got slower than baseline by more than threshold,
+# relative to the fixed workload, and by more than min_delta_ms milliseconds
+def regressions(results, baseline, threshold, min_delta_ms):
+    slower = []
+    for key, entry in results.items():
+        old = baseline.get(key)
+        if not old:
+            continue
+        new, old = entry["total"], old["total"]
+        if new["best_ms"] - old.get("best_ms", old["p50_ms"]) <= min_delta_ms:
+            continue
+        if "relative" in old:
+            ratio = new["relative"] / old["relative"]
+        else:
+            # A baseline from before the calibration: medians
+            ratio = new["p50_ms"] / old["p50_ms"] if old["p50_ms"] else 1.0
+        if ratio > 1 + threshold:
+            slower.append((key, ratio))
+    return slower
+
+
+# The cases of slower that are still slower than baseline by more than
+# threshold when measured again, times times
+def confirmed(slower, baseline, threshold, repeat, rounds, times):
+    kept = []
+    for key, ratio in slower:
+        old = baseline[key]["total"]
+        if "relative" in old:
+            name, size = key.rsplit("/", 1)
+            text = build(name, int(size))
+            for _ in range(times):
+                ratio = min(ratio, measure_total(text, repeat, rounds)["relative"] / old["relative"])
+        if ratio > 1 + threshold:
+            kept.append((key, ratio))
+    return kept
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Latency, throughput and memory benchmark for optimize_text")
+    parser.add_argument("--corpus", action="append", choices=CORPORA, help="only run these corpora")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="comma-separated input sizes, e.g. 1K,1M,50M")
+    parser.add_argument("--full", action="store_const", dest="sizes", const=FULL_SIZES,
+                        help="all sizes from 1K to 50M")
+    parser.add_argument("--repeat", type=int, default=50, help="runs per measurement on small inputs")
+    parser.add_argument("--rounds", type=int, default=5, help="rounds of runs of every whole optimize_text call")
+    parser.add_argument("--runs", type=int, default=1,
+                        help="measure every whole optimize_text call this many times and keep the median")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="fail when a case is this much slower than the baseline")
+    parser.add_argument("--min-delta-ms", type=float, default=0.1,
+                        help="never fail on a case that got slower by no more than this")
+    parser.add_argument("--confirm", type=int, default=2,
+                        help="measure a slower case again this many times, it fails only if slower every time")
+    args = parser.parse_args(argv)
+
+    sizes = [parse_size(size) for size in args.sizes.split(",")]
+    results = run(args.corpus or CORPORA, sizes, args.repeat, args.rounds, args.runs)
+    if args.output:
+        report = {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "results": results,
+        }
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=1)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            baseline = json.load(file)["results"]
+        slower = regressions(results, baseline, args.threshold, args.min_delta_ms)
+        slower = confirmed(slower, baseline, args.threshold, args.repeat, args.rounds, args.confirm)
+        for key, ratio in slower:
+            print(f"REGRESSION {key}: {ratio:.2f}x the baseline")
+        if slower:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
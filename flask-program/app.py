@@ -1,8 +1,77 @@
-from flask import Flask, render_template, request, jsonify
-import re
+import codecs
+import json
+import os
+import sys
+import urllib.parse
+import zlib
+from flask import Flask, Response, render_template, request, jsonify, abort, stream_with_context
+
+# The optimizer engine is shared with the desktop app and lives at the repo root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from text_optimizer import (BatchOptimizer, InstrumentedLimitedOptimizer, LimitedOptimizer, LimitExceeded, Metrics,
+                            Overloaded, ResultCache, SessionStore, StaleRevision, StreamingOptimizer, WorkerPool)
 
 app = Flask(__name__)
 
+# Largest request body, also after decompression; larger ones get a 413
+app.config["MAX_CONTENT_LENGTH"] = int(os.environ.get("OPTIMIZER_MAX_REQUEST_BYTES", 64 * 1024 * 1024))
+
+# JSON answers of / at least this large are gzip or deflate compressed for
+# clients that accept it
+COMPRESS_MIN_BYTES = int(os.environ.get("OPTIMIZER_COMPRESS_MIN_BYTES", 1024))
+COMPRESS_LEVEL = int(os.environ.get("OPTIMIZER_COMPRESS_LEVEL", 6))
+
+# Content codings understood in both directions -> zlib wbits
+ENCODINGS = {"gzip": 16 + zlib.MAX_WBITS, "deflate": zlib.MAX_WBITS}
+
+# Per-stage timings, sizes and span counts for /metrics, collected only with
+# OPTIMIZER_METRICS=1 (also by the worker processes, which send them back);
+# otherwise /metrics has the cache counters alone
+metrics = Metrics()
+METRICS = os.environ.get("OPTIMIZER_METRICS") == "1"
+
+# Documents posted to / are optimized in worker processes with limits on
+# their size, the spans per rule and the time they may take; a worker that
+# runs over is killed and replaced, and when all are busy for longer than the
+# queue wait the request is turned away
+worker_pool = WorkerPool(
+    workers=int(os.environ.get("OPTIMIZER_WORKERS", 0)) or None,
+    timeout=float(os.environ.get("OPTIMIZER_TIMEOUT", 5)),
+    max_bytes=int(os.environ.get("OPTIMIZER_MAX_BYTES", 4 * 1024 * 1024)),
+    max_matches=int(os.environ.get("OPTIMIZER_MAX_MATCHES", 100_000)),
+    wait=float(os.environ.get("OPTIMIZER_QUEUE_WAIT", 2)),
+    metrics=metrics if METRICS else None,
+)
+
+# Sessions and /stream optimize in the request thread, under the same limits
+# on the spans per rule and the seconds spent on a document (an edit of a
+# session, or everything a stream has sent)
+if METRICS:
+    optimizer = InstrumentedLimitedOptimizer(metrics=metrics, max_matches=worker_pool.max_matches,
+                                             timeout=worker_pool.timeout)
+else:
+    optimizer = LimitedOptimizer(max_matches=worker_pool.max_matches, timeout=worker_pool.timeout)
+
+# Results of recent documents (and, for clients that ask for it, the table
+# of their math spans, cached apart): the page posts the whole text on every
+# keystroke, and undo/redo or a second tab resend identical documents
+result_cache = ResultCache(
+    optimize=worker_pool.optimize,
+    max_entries=int(os.environ.get("OPTIMIZER_CACHE_ENTRIES", 256)),
+    max_bytes=int(os.environ.get("OPTIMIZER_CACHE_BYTES", 64 * 1024 * 1024)),
+)
+
+# Live-edit sessions: the page sends its edits and gets back output patches.
+# A session document has the size limit of a posted one, and a request at
+# most OPTIMIZER_MAX_DELTAS edits.
+sessions = SessionStore(
+    optimizer=optimizer,
+    max_sessions=int(os.environ.get("OPTIMIZER_MAX_SESSIONS", 1000)),
+    ttl=int(os.environ.get("OPTIMIZER_SESSION_TTL", 3600)),
+    max_bytes=worker_pool.max_bytes,
+    max_deltas=int(os.environ.get("OPTIMIZER_MAX_DELTAS", 100)),
+)
+
 # def optimize_text(raw_text):
 #     # Remove unprintable characters, allow newlines, tabs, and spaces for indentation
 #     cleaned = "".join(c for c in raw_text if c.isprintable() or c in "\n\t ")
@@ -24,95 +93,6 @@ app = Flask(__name__)
 #     return "\n".join(optimized_lines).rstrip()
 
 
-def optimize_text(raw_text):
-    # Remove unprintable characters, allow newlines, tabs, and spaces for indentation
-    cleaned = "".join(c for c in raw_text if c.isprintable() or c in "\n\t ")
-    
-    # Function to process math content: strip whitespace, fix artifacts, escape underscores
-    def process_math_content(content):
-        content = content.strip()
-        # Fix common copy-paste artifacts from ChatGPT-like content
-        content = content.replace(" ;=; ", " = ")
-        content = content.replace(";", "=")  # Clean up any leftover semicolons in equations
-        # Remove commas that are likely typos in math expressions (e.g., y_i , \log -> y_i \log)
-        content = re.sub(r'(\w|\}|\d)\s*,\s*(\\log|\\sum|\\frac|\\big)', r'\1 \2', content)
-        # Escape underscores for Markdown compatibility
-        escaped_content = content.replace("_", "\\_")
-        return escaped_content
-    
-    # Function to replace standard LaTeX math delimiters (used in Grok-like content)
-    def replace_latex_math(match):
-        if match.group(1) is not None:  # Inline math
-            content = process_math_content(match.group(1))
-            return f"${content}$"
-        elif match.group(2) is not None:  # Display math
-            content = process_math_content(match.group(2))
-            return f"$${content}$$"
-    
-    # First, handle standard LaTeX delimiters (\( \), \[ \])
-    pattern_latex = re.compile(r"\\\((.*?)\\\)|\\\[([\s\S]*?)\\\]", re.DOTALL)
-    optimized = re.sub(pattern_latex, replace_latex_math, cleaned)
-    
-    # Now, handle ChatGPT-style display math: [ math ]
-    def replace_display_chatgpt(match):
-        content = match.group(1)
-        # Check if content likely contains math (e.g., LaTeX commands, symbols)
-        if re.search(r'\\[a-zA-Z]+|_|\^|\{|\}|=|<|>|\\in|\\sum|\\log|\\big|\\hat|\\frac', content):
-            content = process_math_content(content)
-            return f"$${content}$$"
-        else:
-            # If not math, leave unchanged
-            return match.group(0)
-    
-    pattern_display = re.compile(r"\[\s*([\s\S]*?)\s*(?<!\\big)\]", re.DOTALL)
-    optimized = re.sub(pattern_display, replace_display_chatgpt, optimized)
-    
-    # Handle ChatGPT-style inline math: ( math )
-    def replace_inline_chatgpt(match):
-        content = match.group(1)
-        # Skip if too long or empty
-        if len(content) > 100 or not content.strip():
-            return match.group(0)
-        # Skip if already processed (contains $)
-        if '$' in content:
-            return match.group(0)
-        # Skip abbreviations like (CE)
-        stripped_content = content.strip()
-        if stripped_content.isupper() and len(stripped_content) > 1:
-            return match.group(0)
-        # Check if likely math: either has specific math symbols or is short single-word (e.g., variables like y, k)
-        has_math_symbols = re.search(r'\\[a-zA-Z]+|_|\^|\{|\}|=|<|>|\\in|\\sum|\\log|\\big|\\hat|\\frac', content)
-        is_short_variable = (len(content.split()) == 1 and len(content) < 10)
-        if has_math_symbols or is_short_variable:
-            content = process_math_content(content)
-            return f"${content}$"
-        else:
-            # If not math, leave unchanged
-            return match.group(0)
-    
-    pattern_inline = re.compile(r"\(\s*([\s\S]*?)\s*\)", re.DOTALL)
-    
-    # Apply inline replacement only outside of $$ ... $$
-    parts = re.split(r'(\$\$)', optimized)
-    is_math = False
-    optimized_parts = []
-    for part in parts:
-        if part == '$$':
-            is_math = not is_math
-            optimized_parts.append(part)
-        else:
-            if not is_math:
-                part = re.sub(pattern_inline, replace_inline_chatgpt, part)
-            optimized_parts.append(part)
-    optimized = ''.join(optimized_parts)
-    
-    # Split into lines, remove trailing whitespace, preserve blank lines
-    lines = optimized.splitlines()
-    optimized_lines = [line.rstrip() for line in lines]
-    
-    # Join lines and remove trailing newlines
-    return "\n".join(optimized_lines).rstrip()
-
 
 
 
@@ -256,11 +236,295 @@ def optimize_text(raw_text):
 def index():
     if request.method == "POST":
         # Get raw text from the form input
-        raw_text = request.form.get("input_text", "")
-        optimized = optimize_text(raw_text)
-        return jsonify({"optimized": optimized})
+        form = posted_form()
+        raw_text = form.get("input_text", "")
+        spans = form.get("spans") == "1"
+        # A client that already has the answer for this text (it sends the
+        # ETag back in If-None-Match) gets a 304 without it being optimized
+        tag = etag(raw_text, spans)
+        matched = etag_match(request.headers.get("If-None-Match", ""), tag)
+        if matched:
+            return Response(status=304, headers={"ETag": matched, "Vary": "Accept-Encoding"})
+        # Which delimiters the input has and the provider style it looks
+        # like, and with spans=1 where every converted math span is in the
+        # input and the output (UTF-16 offsets), so clients need not parse
+        # the Markdown again. The table takes a slower run of the stages one
+        # by one, so it is only made when asked for.
+        answer = optimize_answer(raw_text, spans)
+        response = jsonify(answer)
+        body, encoding = compress(response.get_data(), request.headers.get("Accept-Encoding", ""))
+        if encoding:
+            response.set_data(body)
+            response.headers["Content-Encoding"] = encoding
+        response.headers["ETag"] = tag_for(tag, encoding)
+        response.vary.add("Accept-Encoding")
+        return response
     # Render the HTML template for GET requests
     return render_template("index.html")
 
+# The form fields, also from a gzip or deflate encoded form body
+def posted_form():
+    if request.headers.get("Content-Encoding", "identity").lower() == "identity":
+        return request.form
+    form = urllib.parse.parse_qs(request_body().decode("utf-8", "replace"), keep_blank_values=True)
+    return {name: values[0] for name, values in form.items()}
+
+# The answer of / to text, with the table of its math spans if spans is true
+def optimize_answer(text, spans=False):
+    if spans:
+        optimized, table = result_cache.optimize(text, spans=True)
+    else:
+        optimized = result_cache.optimize(text)
+    answer = {"optimized": optimized, "classification": optimizer.classify(text)}
+    if spans:
+        answer["spans"] = table.to_json(text, optimized)
+    return answer
+
+# Strong validator of the answer to text: a hash of the text, the version of
+# the optimizer and whether the answer has the span table, which together
+# decide everything in it
+def etag(text, spans=False):
+    return '"%s-%s%s"' % (ResultCache.key(text).hex(), optimizer.version, "-spans" if spans else "")
+
+# The tag of the answer sent with a content coding: a strong ETag differs
+# between codings of the same answer
+def tag_for(tag, encoding):
+    return tag[:-1] + "-" + encoding + '"' if encoding else tag
+
+# The entry of an If-None-Match header that names tag in any coding, or None
+def etag_match(header, tag):
+    if header.strip() == "*":
+        return tag
+    for entry in header.split(","):
+        entry = entry.strip()
+        candidate = entry[2:] if entry.startswith("W/") else entry  # compared weakly, as for GET
+        if candidate in [tag_for(tag, encoding) for encoding in (None, *ENCODINGS)]:
+            return candidate
+    return None
+
+# Content codings of an Accept-Encoding header -> quality
+def accepted_encodings(header):
+    qualities = {}
+    for item in header.split(","):
+        name, *params = item.split(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[name] = quality
+    return qualities
+
+# body compressed with the first coding the client accepts, gzip before
+# deflate, as (body, coding); small bodies are sent as they are, (body, None)
+def compress(body, accept_encoding):
+    if len(body) < COMPRESS_MIN_BYTES:
+        return body, None
+    qualities = accepted_encodings(accept_encoding)
+    for encoding, wbits in ENCODINGS.items():
+        if qualities.get(encoding, qualities.get("*", 0)) > 0:
+            compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, wbits)
+            return compressor.compress(body) + compressor.flush(), encoding
+    return body, None
+
+@app.errorhandler(LimitExceeded)
+def limit_exceeded(error):
+    # Too large, too many spans or edits: 413, too slow: 503
+    metrics.count_rejection(error.limit)
+    status = 503 if error.limit == "seconds" else 413
+    return jsonify({"error": str(error), "limit": error.limit}), status
+
+@app.errorhandler(Overloaded)
+def overloaded(error):
+    metrics.count_rejection("busy")
+    return jsonify({"error": str(error), "limit": "busy"}), 503, {"Retry-After": "1"}
+
+# Batches of documents run on a process pool with one worker per core, each
+# document under the limits above, and only a few batches at a time
+batch_optimizer = BatchOptimizer(
+    workers=int(os.environ.get("OPTIMIZER_BATCH_WORKERS", 0)) or None,
+    max_item_bytes=int(os.environ.get("OPTIMIZER_BATCH_ITEM_BYTES", 4 * 1024 * 1024)),
+    max_matches=worker_pool.max_matches,
+    timeout=worker_pool.timeout,
+    max_batches=int(os.environ.get("OPTIMIZER_MAX_BATCHES", 2)),
+    wait=worker_pool.wait,
+)
+
+# Longest line read from a streamed request body before its output is sent
+STREAM_LINE_LIMIT = 4096
+
+class BadBody(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+# Request body, decompressed if it is gzip or deflate encoded
+def request_body():
+    try:
+        return decode_body(request.get_data(), request.headers.get("Content-Encoding", "identity"),
+                           app.config["MAX_CONTENT_LENGTH"])
+    except BadBody as error:
+        abort(error.status)
+
+# body decoded from its Content-Encoding, or BadBody with the status to
+# answer. Never inflates more than limit, so a small compressed body cannot
+# expand into gigabytes.
+def decode_body(body, encoding, limit):
+    encoding = encoding.strip().lower()
+    if encoding == "identity":
+        return body
+    if encoding not in ENCODINGS:
+        raise BadBody(415, "unsupported content encoding")
+    decompressor = zlib.decompressobj(ENCODINGS[encoding])
+    try:
+        data = decompressor.decompress(body, limit + 1)
+    except zlib.error:
+        raise BadBody(400, "corrupt %s body" % encoding)
+    if len(data) > limit:
+        raise BadBody(413, "request body too large")
+    if not decompressor.eof:
+        raise BadBody(400, "truncated %s body" % encoding)
+    return data
+
+def request_json():
+    try:
+        return json.loads(request_body() or b"{}")
+    except ValueError:
+        abort(400)
+
+@app.route("/session", methods=["POST"])
+def open_session():
+    # Optionally starts with a document: {"text": ...}
+    payload = request_json()
+    if not isinstance(payload, dict):
+        return jsonify({"error": "expected a JSON object"}), 400
+    text = payload.get("text")
+    if isinstance(text, str):
+        worker_pool.check_size(text)
+    session_id = sessions.create()
+    session = sessions.get(session_id)
+    if isinstance(text, str):
+        revision, output = session.replace(text)
+        return jsonify({"session": session_id, "revision": revision, "output": output})
+    return jsonify({"session": session_id, "revision": session.revision})
+
+@app.route("/session/<session_id>", methods=["POST"])
+def edit_session(session_id):
+    # Either {"base": revision, "deltas": [{"start", "end", "text"}, ...]},
+    # edits in order with UTF-16 offsets, answered with the output patches,
+    # or {"text": ...} to replace the whole document, answered with the output
+    session = sessions.get(session_id)
+    if session is None:
+        return jsonify({"error": "unknown session"}), 404
+    payload = request_json()
+    if not isinstance(payload, dict):
+        return jsonify({"error": "expected a JSON object"}), 400
+    if isinstance(payload.get("text"), str):
+        revision, output = session.replace(payload["text"])
+        return jsonify({"revision": revision, "output": output})
+    try:
+        deltas = [(delta["start"], delta["end"], delta["text"]) for delta in payload["deltas"]]
+        if not all(type(start) is int and type(end) is int and isinstance(text, str) for start, end, text in deltas):
+            raise TypeError
+    except (KeyError, TypeError):
+        return jsonify({"error": "expected base and deltas, or text"}), 400
+    try:
+        revision, patches = session.edit(payload.get("base"), deltas)
+    except StaleRevision as error:
+        return jsonify({"error": str(error), "revision": error.revision}), 409
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400
+    return jsonify({
+        "revision": revision,
+        "patches": [{"start": patch.start, "end": patch.end, "text": patch.text} for patch in patches],
+    })
+
+@app.route("/stream", methods=["POST"])
+def stream():
+    # Optimize a UTF-8 request body while it arrives (e.g. a chatbot answer
+    # piped through as it is generated) and send the output as soon as it is
+    # final: as Server-Sent Events if the client accepts them, otherwise as a
+    # chunked text/plain response. The body is read line by line.
+    events = "text/event-stream" in request.headers.get("Accept", "")
+    source = request.stream
+    decoder = codecs.getincrementaldecoder("utf-8")("replace")
+    stream_optimizer = StreamingOptimizer(optimizer)
+
+    def frame(text):
+        if not events:
+            return text
+        # One data line per output line, the client joins them with "\n"
+        return "".join("data: %s\n" % line for line in text.split("\n")) + "\n"
+
+    def generate():
+        try:
+            while True:
+                chunk = source.readline(STREAM_LINE_LIMIT)
+                if not chunk:
+                    break
+                text = stream_optimizer.feed(decoder.decode(chunk))
+                if text:
+                    yield frame(text)
+            text = stream_optimizer.feed(decoder.decode(b"", final=True)) + stream_optimizer.flush()
+        except LimitExceeded as error:
+            # The status is sent already: end the output, with an error event
+            # for Server-Sent Events
+            metrics.count_rejection(error.limit)
+            if events:
+                yield "event: error\ndata: %s\n\n" % json.dumps({"error": str(error), "limit": error.limit})
+            return
+        if text:
+            yield frame(text)
+        if events:
+            yield "event: end\ndata:\n\n"
+
+    mimetype = "text/event-stream" if events else "text/plain"
+    return Response(stream_with_context(generate()), mimetype=mimetype, headers={"Cache-Control": "no-cache"})
+
+@app.route("/batch", methods=["POST"])
+def batch():
+    # Optimize many documents: a JSON array, or NDJSON (one JSON value per
+    # line, Content-Type application/x-ndjson). Every document is a string or
+    # an object with a "text" string. Results come back in the same order,
+    # each {"optimized": ...} or {"error": ...}, with a throughput summary;
+    # NDJSON requests get one result per line and the summary last.
+    ndjson = request.mimetype == "application/x-ndjson"
+    body = request_body()
+    try:
+        if ndjson:
+            documents = [json.loads(line) for line in body.splitlines() if line.strip()]
+        else:
+            documents = json.loads(body)
+    except ValueError:
+        return jsonify({"error": "invalid JSON"}), 400
+    if not isinstance(documents, list):
+        return jsonify({"error": "expected an array of documents"}), 400
+    documents = [document.get("text") if isinstance(document, dict) else document for document in documents]
+
+    results, summary = batch_optimizer.optimize(documents)
+    results = [{"optimized": optimized} if error is None else {"error": error} for optimized, error in results]
+    if ndjson:
+        lines = [json.dumps(result) for result in results]
+        lines.append(json.dumps({"summary": summary}))
+        return Response("\n".join(lines) + "\n", mimetype="application/x-ndjson")
+    return jsonify({"results": results, "summary": summary})
+
+@app.route("/metrics")
+def metrics_text():
+    # Prometheus text exposition format
+    return Response(metrics.render(result_cache), mimetype="text/plain; version=0.0.4")
+
+@app.route("/cache")
+def cache_stats():
+    # Hit/miss/eviction counters of the result cache
+    return jsonify(result_cache.stats())
+
 if __name__ == "__main__":
-    app.run(debug=True, host="0.0.0.0", port=5000)
\ No newline at end of file
+    # Debug mode (reloader, interactive tracebacks) only with FLASK_DEBUG=1
+    app.run(host="0.0.0.0", port=5000)
\ No newline at end of file
@@ -0,0 +1,118 @@
+# Asyncio server mode: the same app behind an ASGI server, e.g.
+#
+#   cd flask-program && uvicorn asgi:app --workers 1
+#
+# POST / is handled on the event loop: requests carry a session key (the
+# "session" form field or an X-Session-Key header) and only the newest text
+# of every session is optimized. A request overtaken by a newer one from the
+# same session, waiting or in progress, is answered with 409 right away (see
+# text_optimizer/coalesce.py). Bodies may be gzip or deflate encoded, and
+# answers are compressed and tagged like those of the Flask endpoint.
+# Everything else is the Flask app, run on threads through asgiref.
+import json
+import urllib.parse
+
+from asgiref.wsgi import WsgiToAsgi
+
+from app import (BadBody, app as flask_app, compress, decode_body, etag, etag_match, metrics, optimize_answer, tag_for,
+                 worker_pool)
+from text_optimizer import Coalescer, LimitExceeded, Overloaded, Superseded
+
+
+# Submitted documents are (text, spans) pairs, spans=1 asks for the table of
+# math spans like on the Flask endpoint
+def optimize(document):
+    return optimize_answer(*document)
+
+
+coalescer = Coalescer(optimize)
+wsgi = WsgiToAsgi(flask_app)
+
+# Answers of / depend on the Accept-Encoding of the request
+VARY = (b"vary", b"accept-encoding")
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+    elif scope["type"] == "http" and scope["method"] == "POST" and scope["path"] == "/":
+        await index(scope, receive, send)
+    else:
+        await wsgi(scope, receive, send)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            worker_pool.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def index(scope, receive, send):
+    limit = flask_app.config["MAX_CONTENT_LENGTH"]
+    body = await read_body(receive, limit)
+    if body is None:
+        return await respond(send, 413, {"error": "request body too large"})
+    headers = dict(scope["headers"])
+    try:
+        body = decode_body(body, headers.get(b"content-encoding", b"identity").decode("latin-1"), limit)
+    except BadBody as error:
+        return await respond(send, error.status, {"error": str(error)})
+    form = urllib.parse.parse_qs(body.decode("utf-8", "replace"), keep_blank_values=True)
+    text = form.get("input_text", [""])[0]
+    spans = form.get("spans", [""])[0] == "1"
+    # Same validators and compression as the Flask endpoint
+    tag = etag(text, spans)
+    matched = etag_match(headers.get(b"if-none-match", b"").decode("latin-1"), tag)
+    if matched:
+        return await send_response(send, 304, b"", [(b"etag", matched.encode("latin-1")), VARY])
+    key = headers.get(b"x-session-key", b"").decode("latin-1") or form.get("session", [""])[0]
+    try:
+        # Requests without a key are never coalesced
+        answer = await coalescer.submit(key or object(), (text, spans))
+    except Superseded as error:
+        return await respond(send, 409, {"error": str(error), "superseded": True})
+    except LimitExceeded as error:
+        metrics.count_rejection(error.limit)
+        status = 503 if error.limit == "seconds" else 413
+        return await respond(send, status, {"error": str(error), "limit": error.limit})
+    except Overloaded as error:
+        metrics.count_rejection("busy")
+        return await respond(send, 503, {"error": str(error), "limit": "busy"}, [(b"retry-after", b"1")])
+    body = json.dumps(answer).encode("utf-8")
+    body, encoding = compress(body, headers.get(b"accept-encoding", b"").decode("latin-1"))
+    headers = [(b"content-type", b"application/json"), (b"etag", tag_for(tag, encoding).encode("latin-1")), VARY]
+    if encoding:
+        headers.append((b"content-encoding", encoding.encode("latin-1")))
+    await send_response(send, 200, body, headers)
+
+
+# The request body, or None once it is larger than limit
+async def read_body(receive, limit):
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if size > limit:
+            return None
+        chunks.append(chunk)
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+async def respond(send, status, payload, headers=()):
+    body = json.dumps(payload).encode("utf-8")
+    await send_response(send, status, body, [(b"content-type", b"application/json")] + list(headers))
+
+
+async def send_response(send, status, body, headers):
+    if status != 304:
+        headers = headers + [(b"content-length", str(len(body)).encode())]
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
@@ -3,7 +3,7 @@
 
 a = Analysis(
     ['app.py'],
-    pathex=[],
+    pathex=['..'],
     binaries=[],
     datas=[('site-packages/PySide6/plugins', 'PySide6/plugins')],
     hiddenimports=['PySide6.QtWidgets', 'PySide6.QtGui', 'PySide6.QtCore'],
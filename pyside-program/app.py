@@ -133,108 +133,117 @@
 
 
 
+import os
 import sys
-import re
+import time
+import traceback
 from PySide6.QtWidgets import (QApplication, QMainWindow, QVBoxLayout, QHBoxLayout, 
-                               QWidget, QTextEdit, QPushButton)
-from PySide6.QtGui import QClipboard
-from PySide6.QtCore import Qt
+                               QWidget, QTextEdit, QPlainTextEdit, QPushButton, QProgressBar, QStackedWidget)
+from PySide6.QtGui import QTextCursor
+from PySide6.QtCore import QObject, QRunnable, QThreadPool, QTimer, Signal
 
-def optimize_text(raw_text):
-    # Remove unprintable characters, allow newlines, tabs, and spaces for indentation
-    cleaned = "".join(c for c in raw_text if c.isprintable() or c in "\n\t ")
-    
-    # Function to process math content: strip whitespace, fix artifacts, escape underscores
-    def process_math_content(content):
-        content = content.strip()
-        # Fix common copy-paste artifacts from ChatGPT-like content
-        content = content.replace(" ;=; ", " = ")
-        content = content.replace(";", "=")  # Clean up any leftover semicolons in equations
-        # Remove commas that are likely typos in math expressions (e.g., y_i , \log -> y_i \log)
-        content = re.sub(r'(\w|\}|\d)\s*,\s*(\\log|\\sum|\\frac|\\big)', r'\1 \2', content)
-        # Escape underscores for Markdown compatibility
-        escaped_content = content.replace("_", "\\_")
-        return escaped_content
-    
-    # Function to replace standard LaTeX math delimiters (used in Grok-like content)
-    def replace_latex_math(match):
-        if match.group(1) is not None:  # Inline math
-            content = process_math_content(match.group(1))
-            return f"${content}$"
-        elif match.group(2) is not None:  # Display math
-            content = process_math_content(match.group(2))
-            return f"$${content}$$"
-    
-    # First, handle standard LaTeX delimiters (\( \), \[ \])
-    pattern_latex = re.compile(r"\\\((.*?)\\\)|\\\[([\s\S]*?)\\\]", re.DOTALL)
-    optimized = re.sub(pattern_latex, replace_latex_math, cleaned)
-    
-    # Now, handle ChatGPT-style display math: [ math ]
-    def replace_display_chatgpt(match):
-        content = match.group(1)
-        # Check if content likely contains math (e.g., LaTeX commands, symbols)
-        if re.search(r'\\[a-zA-Z]+|_|\^|\{|\}|=|<|>|\\in|\\sum|\\log|\\big|\\hat|\\frac', content):
-            content = process_math_content(content)
-            return f"$${content}$$"
-        else:
-            # If not math, leave unchanged
-            return match.group(0)
-    
-    pattern_display = re.compile(r"\[\s*([\s\S]*?)\s*(?<!\\big)\]", re.DOTALL)
-    optimized = re.sub(pattern_display, replace_display_chatgpt, optimized)
-    
-    # Handle ChatGPT-style inline math: ( math )
-    def replace_inline_chatgpt(match):
-        content = match.group(1)
-        # Skip if too long or empty
-        if len(content) > 100 or not content.strip():
-            return match.group(0)
-        # Skip if already processed (contains $)
-        if '$' in content:
-            return match.group(0)
-        # Skip abbreviations like (CE)
-        stripped_content = content.strip()
-        if stripped_content.isupper() and len(stripped_content) > 1:
-            return match.group(0)
-        # Check if likely math: either has specific math symbols or is short single-word (e.g., variables like y, k)
-        has_math_symbols = re.search(r'\\[a-zA-Z]+|_|\^|\{|\}|=|<|>|\\in|\\sum|\\log|\\big|\\hat|\\frac', content)
-        is_short_variable = (len(content.split()) == 1 and len(content) < 10)
-        if has_math_symbols or is_short_variable:
-            content = process_math_content(content)
-            return f"${content}$"
-        else:
-            # If not math, leave unchanged
-            return match.group(0)
-    
-    pattern_inline = re.compile(r"\(\s*([\s\S]*?)\s*\)", re.DOTALL)
-    
-    # Apply inline replacement only outside of $$ ... $$
-    parts = re.split(r'(\$\$)', optimized)
-    is_math = False
-    optimized_parts = []
-    for part in parts:
-        if part == '$$':
-            is_math = not is_math
-            optimized_parts.append(part)
-        else:
-            if not is_math:
-                part = re.sub(pattern_inline, replace_inline_chatgpt, part)
-            optimized_parts.append(part)
-    optimized = ''.join(optimized_parts)
+# The optimizer engine is shared with the web app and lives at the repo root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from text_optimizer import IncrementalOptimizer, ResultCache, default_optimizer
+from text_optimizer.incremental import changed_range, utf16_length
+from text_optimizer.sessions import has_astral
+
+# Documents at least this long are re-optimized incrementally while typing
+INCREMENTAL_MIN_SIZE = 32 * 1024
+
+# Quiet time after the last keystroke before the input is optimized again, in milliseconds
+DEBOUNCE_MS = int(os.environ.get("OPTIMIZER_DEBOUNCE_MS", 150))
+
+# OPTIMIZER_METRICS=1 shows per-stage timings in the status bar
+METRICS = os.environ.get("OPTIMIZER_METRICS") == "1"
+
+# Output documents of at least this many characters are shown in a plain
+# text view, which only lays out the lines on screen
+VIRTUAL_MIN_SIZE = int(os.environ.get("OPTIMIZER_VIRTUAL_MIN_SIZE", 1024 * 1024))
+
+class LiveOptimizer:
+    # Optimizer state of the input document. It is only used from the worker
+    # thread, one job at a time, so jobs see the edits in order.
+    def __init__(self, optimizer=default_optimizer):
+        # Results of recent documents, so undo/redo or pasting the same answer again is instant
+        self.cache = ResultCache(optimize=optimizer.run)
+        
+        # Incremental mode for large documents: only the paragraphs around an
+        # edit are optimized again and only that part of the output is replaced
+        self.incremental = IncrementalOptimizer(optimizer, utf16=True)
+        self.incremental_active = False
     
-    # Split into lines, remove trailing whitespace, preserve blank lines
-    lines = optimized.splitlines()
-    optimized_lines = [line.rstrip() for line in lines]
+    # Returns the whole output document as a string, or the Patch that turns
+    # the previous output into the new one. hint is the edited range, if known.
+    def optimize(self, raw_text, hint):
+        if len(raw_text) < INCREMENTAL_MIN_SIZE:
+            self.incremental_active = False
+            return self.cache.optimize(raw_text)
+        if not self.incremental_active:
+            # Entering incremental mode: optimize the whole document once
+            self.incremental_active = True
+            return self.incremental.reset(raw_text)
+        return self.incremental.update(raw_text, *hint)
+
+class JobSignals(QObject):
+    finished = Signal(int, object, float)  # generation, result (None if optimizing failed), seconds
+    failed = Signal(str)  # the exception, on one line, emitted before finished
+
+def describe_error(error):
+    return "".join(traceback.format_exception_only(type(error), error)).strip()
+
+class OptimizeJob(QRunnable):
+    def __init__(self, live, generation, raw_text, hint):
+        super().__init__()
+        self.live = live
+        self.generation = generation
+        self.raw_text = raw_text
+        self.hint = hint
+        self.signals = JobSignals()
     
-    # Join lines and remove trailing newlines
-    return "\n".join(optimized_lines).rstrip()
+    def run(self):
+        started = time.perf_counter()
+        try:
+            result = self.live.optimize(self.raw_text, self.hint)
+        except Exception as error:
+            self.signals.failed.emit(describe_error(error))
+            # The next job starts over from the whole document
+            self.live.incremental_active = False
+            result = None
+        self.signals.finished.emit(self.generation, result, time.perf_counter() - started)
 
 class TextOptimizerWindow(QMainWindow):
-    def __init__(self):
+    first_paint = Signal()  # the window has been drawn for the first time
+    
+    def __init__(self, debounce_ms=DEBOUNCE_MS, metrics=METRICS):
         super().__init__()
+        self.painted = False
         self.setWindowTitle("Chatbot Text Optimizer")
         self.setGeometry(100, 100, 600, 400)
         
+        # Optimizing runs on a single worker thread, so the editor stays
+        # responsive however large the document is
+        if metrics:
+            from text_optimizer import InstrumentedOptimizer
+            self.optimizer = InstrumentedOptimizer()
+            self.metrics = self.optimizer.metrics
+        else:
+            self.optimizer = default_optimizer
+            self.metrics = None
+        self.live = LiveOptimizer(self.optimizer)
+        self.pool = QThreadPool()
+        self.pool.setMaxThreadCount(1)
+        self.job = None  # the job in flight, at most one
+        self.generation = 0  # bumped on every edit, results of older generations are superseded
+        self.changes = []  # contentsChange(position, removed, added) since the last job started
+        self.unapplied = []  # superseded results, in order, not shown yet
+        
+        # Wait for a pause in typing before starting a job
+        self.debounce = QTimer(self)
+        self.debounce.setSingleShot(True)
+        self.debounce.setInterval(debounce_ms)
+        self.debounce.timeout.connect(self.start_job)
+        
         # Main widget and layout
         main_widget = QWidget()
         self.setCentralWidget(main_widget)
@@ -245,11 +254,21 @@ class TextOptimizerWindow(QMainWindow):
         self.input_field.setPlaceholderText("Paste chatbot text here...")
         layout.addWidget(self.input_field)
         
-        # Output field
+        # Output field, and a plain text view that takes its place for very
+        # large documents. Neither keeps an undo history: the output is only
+        # ever changed by the optimizer, and the history would grow with
+        # every edit of the input.
         self.output_field = QTextEdit()
         self.output_field.setPlaceholderText("Optimized Markdown text will appear here...")
         self.output_field.setReadOnly(True)
-        layout.addWidget(self.output_field)
+        self.large_output_field = QPlainTextEdit()
+        self.large_output_field.setReadOnly(True)
+        self.outputs = QStackedWidget()
+        for field in (self.output_field, self.large_output_field):
+            field.document().setUndoRedoEnabled(False)
+            self.outputs.addWidget(field)
+        layout.addWidget(self.outputs)
+        self.output_text = ""  # what the output shows, None after patches until it is needed
         
         # Buttons layout
         button_layout = QHBoxLayout()
@@ -259,7 +278,16 @@ class TextOptimizerWindow(QMainWindow):
         button_layout.addWidget(self.clear_button)
         layout.addLayout(button_layout)
         
+        # Busy indicator, shown while a job is in flight
+        self.busy = QProgressBar()
+        self.busy.setRange(0, 0)
+        self.busy.setMaximumWidth(120)
+        self.busy.setTextVisible(False)
+        self.busy.hide()
+        self.statusBar().addPermanentWidget(self.busy)
+        
         # Connect signals
+        self.input_field.document().contentsChange.connect(self.track_change)
         self.input_field.textChanged.connect(self.optimize)
         self.copy_button.clicked.connect(self.copy_to_clipboard)
         self.clear_button.clicked.connect(self.clear_fields)
@@ -269,7 +297,7 @@ class TextOptimizerWindow(QMainWindow):
             QMainWindow {
                 background-color: #f0f0f0;
             }
-            QTextEdit {
+            QTextEdit, QPlainTextEdit {
                 border: 1px solid #ccc;
                 border-radius: 5px;
                 padding: 5px;
@@ -277,7 +305,7 @@ class TextOptimizerWindow(QMainWindow):
                 font-size: 14px;
                 background-color: white;
             }
-            QTextEdit[readOnly="true"] {
+            QTextEdit[readOnly="true"], QPlainTextEdit[readOnly="true"] {
                 background-color: #f9f9f9;  /* Light gray for read-only field */
             }
             QPushButton {
@@ -296,21 +324,259 @@ class TextOptimizerWindow(QMainWindow):
             }
         """)
     
+    def track_change(self, position, removed, added):
+        self.changes.append((position, removed, added))
+    
     def optimize(self):
+        self.generation += 1
+        self.debounce.start()
+    
+    def start_job(self):
+        if self.job is not None:
+            # Started again when the running job finishes
+            return
         raw_text = self.input_field.toPlainText()
-        optimized = optimize_text(raw_text)
-        self.output_field.setPlainText(optimized)
+        changes, self.changes = self.changes, []
+        # Qt counts positions in UTF-16 units, they are string indices as long
+        # as the text has no characters outside the BMP. Without a usable hint
+        # the changed range is found by comparing the texts.
+        hint = ()
+        if len(changes) == 1 and len(raw_text) == self.input_field.document().characterCount() - 1:
+            position, removed, added = changes[0]
+            hint = (position, position + removed, position + added)
+        self.job = OptimizeJob(self.live, self.generation, raw_text, hint)
+        self.job.signals.finished.connect(self.job_finished)
+        self.job.signals.failed.connect(self.job_failed)
+        self.busy.show()
+        self.pool.start(self.job)
+    
+    def job_failed(self, message):
+        # The app is built without a console, so this is where errors show
+        self.statusBar().showMessage("Optimization failed: %s" % message, 10000)
+    
+    def job_finished(self, generation, result, seconds):
+        self.job = None
+        if result is None:
+            # Earlier patches cannot be trusted either, the next job sends the whole document
+            self.unapplied = []
+        elif generation != self.generation:
+            # Superseded while running. Its patch is kept, because the next
+            # patch is relative to it, but it is only applied together with
+            # the result of the latest text.
+            if isinstance(result, str):
+                self.unapplied = [result]
+            else:
+                self.unapplied.append(result)
+        else:
+            self.apply(self.unapplied + [result])
+            self.unapplied = []
+            if self.metrics is not None:
+                self.show_metrics(result, seconds)
+        if generation != self.generation and not self.debounce.isActive():
+            self.start_job()
+        elif self.job is None:
+            self.busy.hide()
+    
+    def apply(self, results):
+        # A whole document replaces everything before it
+        for index in range(len(results) - 1, -1, -1):
+            if isinstance(results[index], str):
+                self.show_output(results[index])
+                results = results[index + 1:]
+                break
+        if not results:
+            return
+        # Replace only the changed ranges of the output document, as one edit
+        cursor = QTextCursor(self.outputs.currentWidget().document())
+        cursor.beginEditBlock()
+        for patch in results:
+            cursor.setPosition(patch.start)
+            cursor.setPosition(patch.end, QTextCursor.MoveMode.KeepAnchor)
+            cursor.insertText(patch.text)
+        cursor.endEditBlock()
+        self.output_text = None
+        if self.outputs.currentWidget() is not self.view_for(self.output_document_size()):
+            self.show_output(self.outputs.currentWidget().toPlainText())
+    
+    def output_document_size(self):
+        return self.outputs.currentWidget().document().characterCount() - 1
+    
+    def view_for(self, size):
+        return self.large_output_field if size >= VIRTUAL_MIN_SIZE else self.output_field
+    
+    def show_output(self, text):
+        field = self.view_for(len(text))
+        current = self.outputs.currentWidget()
+        if field is not current:
+            # Switching views: the document is laid out once by the new view
+            # and the old one lets go of its copy
+            current.clear()
+            field.setPlainText(text)
+            self.outputs.setCurrentWidget(field)
+            self.output_text = text
+            return
+        # Setting the whole text again would throw the document away and lay
+        # it out from scratch; only the part that changed is replaced
+        old = self.output_text if self.output_text is not None else current.toPlainText()
+        start, old_end, new_end = changed_range(old, text)
+        if start != old_end or start != new_end:
+            inserted = text[start:new_end]
+            if has_astral(old) or has_astral(text):
+                # Qt positions are in UTF-16 units
+                start, old_end = utf16_length(old[:start]), utf16_length(old[:old_end])
+            cursor = QTextCursor(current.document())
+            cursor.beginEditBlock()
+            cursor.setPosition(start)
+            cursor.setPosition(old_end, QTextCursor.MoveMode.KeepAnchor)
+            cursor.insertText(inserted)
+            cursor.endEditBlock()
+        self.output_text = text
+    
+    def show_metrics(self, result, seconds):
+        # Debug status line: the last job, the stages of the last run (whole
+        # document or edit), span counts and cache hits
+        summary = self.metrics.summary()
+        cache = self.live.cache.stats()
+        mode = "whole" if isinstance(result, str) else "incremental"
+        stages = "  ".join("%s %.1f" % (name, elapsed * 1000) for name, elapsed in summary["last"].items())
+        self.statusBar().showMessage("%s %.1f ms | stages (ms) %s | spans %d converted, %d kept | cache %d/%d hits" % (
+            mode, seconds * 1000, stages or "-", summary["converted"], summary["kept"],
+            cache["hits"], cache["hits"] + cache["misses"]))
     
     def copy_to_clipboard(self):
         clipboard = QApplication.clipboard()
-        clipboard.setText(self.output_field.toPlainText())
+        clipboard.setText(self.outputs.currentWidget().toPlainText())
     
     def clear_fields(self):
+        # The output follows through the usual job, clearing it here would
+        # leave patches of a job in flight nothing to apply to
         self.input_field.clear()
-        self.output_field.clear()
+    
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        if not self.painted:
+            self.painted = True
+            self.first_paint.emit()
+    
+    def closeEvent(self, event):
+        self.debounce.stop()
+        self.pool.waitForDone()
+        super().closeEvent(event)
+
+class ClipboardJob(QRunnable):
+    def __init__(self, cache, generation, raw_text):
+        super().__init__()
+        self.cache = cache
+        self.generation = generation
+        self.raw_text = raw_text
+        self.signals = JobSignals()
+    
+    def run(self):
+        started = time.perf_counter()
+        try:
+            result = self.cache.optimize(self.raw_text)
+        except Exception as error:
+            self.signals.failed.emit(describe_error(error))
+            result = None
+        self.signals.finished.emit(self.generation, result, time.perf_counter() - started)
+
+class ClipboardWatcher(QObject):
+    # Optimizes every text copied to the clipboard and puts the result back.
+    # It only wakes up on QClipboard.dataChanged, so it costs nothing while
+    # idle; the optimizer runs on a worker thread. Text it wrote itself is
+    # recognized by its hash and left alone, as is text that comes out
+    # unchanged (so rich clipboard contents are not replaced by plain text).
+    optimized = Signal(float)  # a result was written back, seconds since the copy
+    failed = Signal(str)  # optimizing a copied text raised, the exception on one line
+    
+    def __init__(self, clipboard, optimizer=default_optimizer):
+        super().__init__()
+        self.clipboard = clipboard
+        self.cache = ResultCache(optimize=optimizer.run)
+        self.pool = QThreadPool()
+        self.pool.setMaxThreadCount(1)
+        self.enabled = True
+        self.written = None  # hash of the text last written to the clipboard
+        self.generation = 0  # bumped on every copy, only the latest result is written
+        self.job = None
+        self.waiting = None  # text copied while a job was running
+        self.copied_at = 0.0
+        clipboard.dataChanged.connect(self.changed)
+    
+    def changed(self):
+        if not self.enabled or not self.clipboard.mimeData().hasText():
+            return
+        raw_text = self.clipboard.text()
+        if not raw_text or ResultCache.key(raw_text) == self.written:
+            return
+        self.generation += 1
+        self.copied_at = time.perf_counter()
+        if self.job is not None:
+            self.waiting = raw_text
+            return
+        self.start_job(raw_text)
+    
+    def start_job(self, raw_text):
+        self.job = ClipboardJob(self.cache, self.generation, raw_text)
+        self.job.signals.finished.connect(self.job_finished)
+        self.job.signals.failed.connect(self.failed)
+        self.pool.start(self.job)
+    
+    def job_finished(self, generation, result, seconds):
+        raw_text = self.job.raw_text
+        self.job = None
+        if self.waiting is not None:
+            waiting, self.waiting = self.waiting, None
+            self.start_job(waiting)
+        elif generation == self.generation and result is not None and result != raw_text:
+            self.written = ResultCache.key(result)
+            self.clipboard.setText(result)
+            self.optimized.emit(time.perf_counter() - self.copied_at)
+    
+    def stop(self):
+        self.enabled = False
+        self.pool.waitForDone()
+
+def run_tray(app):
+    # Clipboard daemon: no window until asked for one, an icon in the system
+    # tray when there is one (the offscreen platform has none)
+    from PySide6.QtWidgets import QMenu, QStyle, QSystemTrayIcon
+    app.setQuitOnLastWindowClosed(False)
+    watcher = ClipboardWatcher(QApplication.clipboard())
+    app.aboutToQuit.connect(watcher.stop)
+    if not QSystemTrayIcon.isSystemTrayAvailable():
+        return watcher, None
+    tray = QSystemTrayIcon(app.style().standardIcon(QStyle.StandardPixmap.SP_FileDialogContentsView), app)
+    tray.setToolTip("Chatbot Text Optimizer: watching the clipboard")
+    menu = QMenu()
+    pause = menu.addAction("Pause")
+    pause.setCheckable(True)
+    pause.toggled.connect(lambda paused: setattr(watcher, "enabled", not paused))
+    windows = []
+    def open_window():
+        if not windows:
+            windows.append(TextOptimizerWindow())
+        windows[0].show()
+        windows[0].raise_()
+    menu.addAction("Open window").triggered.connect(open_window)
+    menu.addAction("Quit").triggered.connect(app.quit)
+    tray.setContextMenu(menu)
+    watcher.optimized.connect(lambda seconds: tray.setToolTip(
+        "Chatbot Text Optimizer: last clipboard optimized in %.0f ms" % (seconds * 1000)))
+    watcher.failed.connect(lambda message: tray.setToolTip(
+        "Chatbot Text Optimizer: could not optimize the last clipboard (%s)" % message))
+    tray.show()
+    return watcher, tray
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
+    if "--tray" in sys.argv[1:]:
+        # python app.py --tray: optimize whatever is copied, without a window
+        daemon = run_tray(app)
+        sys.exit(app.exec())
     window = TextOptimizerWindow()
+    if os.environ.get("OPTIMIZER_EXIT_AFTER_PAINT") == "1":
+        # For benchmarks/startup.py: quit as soon as the window is on screen
+        window.first_paint.connect(app.quit)
     window.show()
-    sys.exit(app.exec())
\ No newline at end of file
+    sys.exit(app.exec())
@@ -0,0 +1,44 @@
+# The engine is imported right away; everything else (process pools, asyncio,
+# the servers' helpers) is only imported when first used, so front-ends that
+# just optimize text, like the desktop app, start without paying for it.
+import importlib
+
+from .engine import Optimizer, default_optimizer, optimize_text, process_math_content
+from .rules import RULES, Rule
+
+# Name -> module it lives in
+LAZY = {
+    "ResultCache": "cache",
+    "IncrementalOptimizer": "incremental",
+    "Patch": "incremental",
+    "EditSession": "sessions",
+    "SessionStore": "sessions",
+    "StaleRevision": "sessions",
+    "StreamingOptimizer": "streaming",
+    "BatchOptimizer": "batch",
+    "InstrumentedOptimizer": "metrics",
+    "Metrics": "metrics",
+    "ParallelOptimizer": "parallel",
+    "SpanTable": "spans",
+    "trace": "spans",
+    "LimitedOptimizer": "workers",
+    "InstrumentedLimitedOptimizer": "workers",
+    "LimitExceeded": "workers",
+    "Overloaded": "workers",
+    "WorkerPool": "workers",
+    "Coalescer": "coalesce",
+    "Superseded": "coalesce",
+}
+
+
+def __getattr__(name):
+    module = LAZY.get(name)
+    if module is None:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    value = getattr(importlib.import_module("." + module, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(LAZY))
@@ -0,0 +1,131 @@
+# Optimizing many documents at once on all cores.
+#
+# The optimizer is pure Python and holds the GIL, so threads do not help;
+# documents are sent to a pool of worker processes instead, in chunks to keep
+# the pickling overhead per document low. Small batches are not worth the
+# round trip and run in the calling process.
+#
+# Every document has the budget of a LimitedOptimizer (spans per rule and
+# seconds, see workers.py), so one bad document fails alone instead of
+# holding a worker, and only max_batches batches run at once; a batch that
+# finds no room within the wait is turned away with Overloaded.
+import functools
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from .engine import spawn_context
+from .workers import MAX_MATCHES, TIMEOUT, LimitedOptimizer, Overloaded
+
+# Documents larger than this are rejected, in UTF-8 bytes
+MAX_ITEM_BYTES = 4 * 1024 * 1024
+
+# Batches smaller than this run in the calling process, in UTF-8 bytes
+MIN_POOL_BYTES = 256 * 1024
+
+# Batches optimized at the same time
+MAX_BATCHES = 2
+
+# LimitedOptimizer per (max_matches, timeout), in each process
+OPTIMIZERS = {}
+
+
+# Runs in the worker processes: (optimized, None) or (None, error message)
+def optimize_document(text, max_matches=MAX_MATCHES, timeout=TIMEOUT):
+    optimizer = OPTIMIZERS.get((max_matches, timeout))
+    if optimizer is None:
+        optimizer = OPTIMIZERS[max_matches, timeout] = LimitedOptimizer(max_matches=max_matches, timeout=timeout)
+    try:
+        return optimizer.run(text), None
+    except Exception as error:
+        return None, "%s: %s" % (type(error).__name__, error)
+
+
+class BatchOptimizer:
+    # A process pool, started on first use and shared by all batches
+    def __init__(self, workers=None, max_item_bytes=MAX_ITEM_BYTES, min_pool_bytes=MIN_POOL_BYTES,
+                 max_matches=MAX_MATCHES, timeout=TIMEOUT, max_batches=MAX_BATCHES, wait=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_item_bytes = max_item_bytes
+        self.min_pool_bytes = min_pool_bytes
+        self.optimize_document = functools.partial(optimize_document, max_matches=max_matches, timeout=timeout)
+        self.max_batches = max_batches
+        self.wait = timeout if wait is None else wait
+        self.slots = threading.BoundedSemaphore(max_batches)
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def executor(self):
+        with self.lock:
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(self.workers, mp_context=spawn_context())
+            return self.pool
+
+    def close(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown()
+                self.pool = None
+
+    # Optimize documents (strings) and return the results in the same order,
+    # each (optimized, None) or (None, error message), and a summary
+    def optimize(self, documents):
+        if not self.slots.acquire(timeout=self.wait):
+            raise Overloaded("%d batches running for %gs" % (self.max_batches, self.wait))
+        try:
+            return self.optimize_batch(documents)
+        finally:
+            self.slots.release()
+
+    def optimize_batch(self, documents):
+        started = time.perf_counter()
+        results = [None] * len(documents)
+        texts = []
+        positions = []
+        total_bytes = 0
+        for position, text in enumerate(documents):
+            if not isinstance(text, str):
+                results[position] = (None, "expected a string")
+                continue
+            size = len(text.encode("utf-8", "surrogatepass"))
+            if size > self.max_item_bytes:
+                results[position] = (None, "document of %d bytes exceeds the limit of %d" % (size, self.max_item_bytes))
+                continue
+            texts.append(text)
+            positions.append(position)
+            total_bytes += size
+
+        for position, result in zip(positions, self.map(texts, total_bytes)):
+            results[position] = result
+
+        seconds = time.perf_counter() - started
+        summary = {
+            "documents": len(documents),
+            "errors": sum(1 for _, error in results if error is not None),
+            "bytes": total_bytes,
+            "seconds": round(seconds, 6),
+            "docs_per_second": round(len(documents) / seconds, 1) if seconds else None,
+            "bytes_per_second": round(total_bytes / seconds) if seconds else None,
+            "workers": self.workers,
+        }
+        return results, summary
+
+    def map(self, texts, total_bytes):
+        if self.workers == 1 or len(texts) < 2 or total_bytes < self.min_pool_bytes:
+            return [self.optimize_document(text) for text in texts]
+        # A few chunks per worker, so uneven documents still balance out
+        chunksize = max(1, len(texts) // (self.workers * 4))
+        results = []
+        try:
+            results.extend(self.executor().map(self.optimize_document, texts, chunksize=chunksize))
+        except BrokenProcessPool:
+            # A worker died (e.g. killed for running out of memory): the
+            # documents without a result fail, the next batch gets a new pool
+            with self.lock:
+                if self.pool is not None:
+                    self.pool.shutdown(wait=False, cancel_futures=True)
+                    self.pool = None
+            results.extend((None, "worker process died") for _ in texts[len(results):])
+        return results
@@ -0,0 +1,88 @@
+# Bounded LRU cache of optimized documents, keyed by a hash of the input.
+#
+# Both front-ends optimize the whole document on every edit, and undo/redo,
+# pasting the same answer again or a second browser tab send byte-identical
+# text over and over. Those repeats are answered from here without running
+# the optimizer.
+import hashlib
+import sys
+import threading
+from collections import OrderedDict
+
+from .engine import optimize_text
+
+
+class ResultCache:
+    def __init__(self, optimize=optimize_text, max_entries=256, max_bytes=64 * 1024 * 1024):
+        self.optimize_uncached = optimize
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (result, size), least recently used first
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()  # Flask serves requests from several threads
+
+    @staticmethod
+    def key(text):
+        return hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, result):
+        # A result may also be a tuple, e.g. the output and its span table
+        parts = result if isinstance(result, tuple) else (result,)
+        size = sum(map(sys.getsizeof, parts)) + sys.getsizeof(key)
+        if size > self.max_bytes or self.max_entries <= 0:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self.entries[key] = (result, size)
+            self.bytes += size
+            # Drop the least recently used entries until both limits hold again
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.bytes -= evicted
+                self.evictions += 1
+
+    # Options are passed on to the optimize function; the result for the
+    # same text with other options is an entry of its own
+    def optimize(self, text, **options):
+        key = self.key(text)
+        if options:
+            key = (key, tuple(sorted(options.items())))
+        result = self.get(key)
+        if result is None:
+            # Computed outside the lock, two threads may race on the same
+            # document but they produce the same result
+            result = self.optimize_uncached(text, **options)
+            self.put(key, result)
+        return result
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
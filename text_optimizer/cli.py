@@ -0,0 +1,375 @@
+# Command-line mode: optimize files, directory trees and JSONL archives.
+#
+#   python -m text_optimizer notes.md answers/ --output optimized/
+#   python -m text_optimizer export.jsonl --field message.content --in-place
+#   python -m text_optimizer answers/ --in-place --manifest .optimizer-manifest.json
+#
+# Plain files are optimized whole on the worker processes, one file per task;
+# files of --large-bytes or more are memory-mapped and run through a
+# StreamingOptimizer, so they are never held in memory as a whole. A file of
+# --parallel-bytes or more is not left to one worker: it is cut into chunks
+# after newlines that all workers optimize (see parallel.py), a few per
+# worker in flight at a time, and written out in order. JSONL files
+# are read record by record and sent to the workers in batches, with a
+# bounded number of batches in flight, and written back in order; records
+# without the field, or whose field does not change, are copied byte for byte.
+#
+# Results are always written to a temporary file next to the destination and
+# moved into place, so an interrupted run never leaves a half-written file.
+# With --manifest, the content hash of every file is recorded with the
+# optimizer version, and files that have not changed since the last run are
+# skipped; after a change of the engine or the rules, they are all optimized
+# again.
+import argparse
+import codecs
+import fnmatch
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from .engine import default_optimizer, optimize_text
+from .parallel import cut_points, optimize_parts
+from .streaming import StreamingOptimizer
+
+DEFAULT_PATTERNS = ("*.md", "*.txt", "*.jsonl")
+JSONL_SUFFIXES = (".jsonl", ".ndjson")
+
+# Files at least this large are memory-mapped and optimized as a stream
+LARGE_BYTES = 64 * 1024 * 1024
+STREAM_CHUNK = 1024 * 1024
+
+# Files at least this large are optimized on all workers at once, in chunks
+# of about PARALLEL_CHUNK bytes, at least CHUNKS_PER_WORKER per worker
+PARALLEL_BYTES = 16 * 1024 * 1024
+PARALLEL_CHUNK = 4 * 1024 * 1024
+CHUNKS_PER_WORKER = 4
+
+# JSONL records sent to a worker at once, at most this many bytes or records
+BATCH_BYTES = 1024 * 1024
+BATCH_RECORDS = 1000
+
+
+def new_hash():
+    return hashlib.blake2b(digest_size=16)
+
+
+class InlineExecutor:
+    # Runs every task right away in this process, for --workers 1
+    def submit(self, fn, *args):
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as error:
+            future.set_exception(error)
+        return future
+
+    def shutdown(self):
+        pass
+
+
+class AtomicWriter:
+    # A binary file written next to path and moved over it when complete;
+    # keeps the hash of everything written
+    def __init__(self, path, mode_from=None):
+        self.path = path
+        self.mode_from = mode_from
+        self.hash = new_hash()
+
+    def __enter__(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        self.file = tempfile.NamedTemporaryFile("wb", dir=directory, prefix=".optimizing-", delete=False)
+        return self
+
+    def write(self, data):
+        self.hash.update(data)
+        self.file.write(data)
+
+    def __exit__(self, kind, error, traceback):
+        self.file.close()
+        if kind is not None:
+            os.unlink(self.file.name)
+            return False
+        if self.mode_from is not None:
+            shutil.copymode(self.mode_from, self.file.name)
+        os.replace(self.file.name, self.path)
+        return False
+
+
+# Runs in the worker processes, or with an executor in this process, whose
+# workers then optimize the file in chunks. Returns (status, input hash,
+# output hash, bytes read)
+def optimize_file(source, dest, skip, large_bytes, executor=None, workers=1):
+    with open(source, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        if size >= large_bytes:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            data = file.read()
+        try:
+            digest = new_hash()
+            digest.update(data)
+            digest = digest.hexdigest()
+            if digest in skip:
+                return "skipped", digest, None, size
+            with AtomicWriter(dest, mode_from=source) as out:
+                if executor is not None:
+                    write_parallel(executor, workers, data, out)
+                elif size >= large_bytes:
+                    write_stream(data, out)
+                else:
+                    out.write(optimize_text(data.decode("utf-8", "replace")).encode("utf-8"))
+        finally:
+            if size >= large_bytes:
+                data.close()
+    return "optimized", digest, out.hash.hexdigest(), size
+
+
+def write_stream(data, out):
+    decoder = codecs.getincrementaldecoder("utf-8")("replace")
+    optimizer = StreamingOptimizer()
+    for pos in range(0, len(data), STREAM_CHUNK):
+        out.write(optimizer.feed(decoder.decode(data[pos:pos + STREAM_CHUNK])).encode("utf-8"))
+    out.write((optimizer.feed(decoder.decode(b"", final=True)) + optimizer.flush()).encode("utf-8"))
+
+
+def write_parallel(executor, workers, data, out):
+    count = max(workers * CHUNKS_PER_WORKER, len(data) // PARALLEL_CHUNK)
+    bounds = [0] + cut_points(data, count, b"\n") + [len(data)]
+    # Whitespace at the end of the output so far, dropped if nothing follows
+    blanks = ""
+    for part in optimize_parts(executor, data, bounds, 2 * workers):
+        body = part.rstrip(" \t\n")
+        if body:
+            out.write((blanks + body).encode("utf-8"))
+            blanks = part[len(body):]
+        else:
+            blanks += part
+
+
+# Runs in the worker processes: the optimized lines of a batch of JSONL
+# records and the number of lines that were not valid JSON
+def optimize_records(lines, field):
+    path = field.split(".")
+    output = []
+    invalid = 0
+    for line in lines:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            invalid += bool(line.strip())
+            output.append(line)
+            continue
+        target = record
+        try:
+            for key in path[:-1]:
+                target = target[key]
+            value = target[path[-1]]
+        except (KeyError, TypeError):
+            value = None
+        optimized = optimize_text(value) if isinstance(value, str) else value
+        if optimized == value:
+            output.append(line)
+            continue
+        target[path[-1]] = optimized
+        end = b"\n" if line.endswith(b"\n") else b""
+        output.append(json.dumps(record, ensure_ascii=False).encode("utf-8") + end)
+    return output, invalid
+
+
+def read_batches(file):
+    batch = []
+    size = 0
+    for line in file:
+        batch.append(line)
+        size += len(line)
+        if size >= BATCH_BYTES or len(batch) >= BATCH_RECORDS:
+            yield batch
+            batch = []
+            size = 0
+    if batch:
+        yield batch
+
+
+def file_hash(path):
+    with open(path, "rb") as file:
+        return hashlib.file_digest(file, new_hash).hexdigest()
+
+
+class BulkOptimizer:
+    def __init__(self, output=None, field="content", workers=None, manifest=None, large_bytes=LARGE_BYTES,
+                 patterns=DEFAULT_PATTERNS, parallel_bytes=PARALLEL_BYTES):
+        self.output = output  # destination directory, None to optimize in place
+        self.field = field
+        self.workers = workers or os.cpu_count() or 1
+        self.large_bytes = large_bytes
+        self.parallel_bytes = parallel_bytes
+        self.patterns = patterns
+        self.manifest_path = manifest
+        self.manifest = {}  # source path -> {"input": hash, "output": hash, "version": optimizer version}
+        if manifest and os.path.exists(manifest):
+            with open(manifest, encoding="utf-8") as file:
+                self.manifest = json.load(file)
+        # errors: files that failed; invalid_lines: JSONL lines copied as
+        # they were because they are not valid JSON
+        self.stats = {"optimized": 0, "skipped": 0, "errors": 0, "invalid_lines": 0, "records": 0, "bytes": 0}
+
+    # (source, destination) of every file to process
+    def targets(self, paths):
+        for path in paths:
+            if os.path.isdir(path):
+                for root, dirs, files in os.walk(path):
+                    dirs.sort()
+                    if self.output:
+                        # Never descend into the output of this run
+                        dirs[:] = [name for name in dirs
+                                   if os.path.abspath(os.path.join(root, name)) != os.path.abspath(self.output)]
+                    for name in sorted(files):
+                        if any(fnmatch.fnmatch(name, pattern) for pattern in self.patterns):
+                            source = os.path.join(root, name)
+                            yield source, self.destination(source, os.path.relpath(source, path))
+            else:
+                yield path, self.destination(path, os.path.basename(path))
+
+    def destination(self, source, relative):
+        return os.path.join(self.output, relative) if self.output else source
+
+    # Hashes meaning the file is unchanged since the last run, by the same optimizer
+    def unchanged(self, source, dest):
+        entry = self.manifest.get(os.path.abspath(source))
+        if not entry or entry.get("version") != default_optimizer.version:
+            return set()
+        if self.output is None:
+            return {entry["output"]}
+        return {entry["input"]} if os.path.exists(dest) else set()
+
+    def record(self, source, input_hash, output_hash):
+        self.manifest[os.path.abspath(source)] = {"input": input_hash, "output": output_hash,
+                                                  "version": default_optimizer.version}
+
+    def run(self, paths):
+        executor = ProcessPoolExecutor(self.workers) if self.workers > 1 else InlineExecutor()
+        try:
+            files = []
+            for source, dest in self.targets(paths):
+                if source.endswith(JSONL_SUFFIXES):
+                    self.run_jsonl(executor, source, dest)
+                elif self.workers > 1 and self.size(source) >= self.parallel_bytes:
+                    # Runs here, its chunks on the workers
+                    try:
+                        result = optimize_file(source, dest, self.unchanged(source, dest), self.large_bytes,
+                                               executor, self.workers)
+                    except Exception as error:
+                        self.error(source, error)
+                        continue
+                    self.done(source, *result)
+                else:
+                    files.append((source, executor.submit(optimize_file, source, dest,
+                                                          self.unchanged(source, dest), self.large_bytes)))
+            for source, future in files:
+                try:
+                    result = future.result()
+                except Exception as error:
+                    self.error(source, error)
+                    continue
+                self.done(source, *result)
+        finally:
+            executor.shutdown()
+            self.save_manifest()
+        return self.stats
+
+    @staticmethod
+    def size(source):
+        # A file that cannot be read fails where it is opened
+        try:
+            return os.path.getsize(source)
+        except OSError:
+            return 0
+
+    def done(self, source, status, input_hash, output_hash, size):
+        self.stats[status] += 1
+        self.stats["bytes"] += size
+        if status == "optimized":
+            self.record(source, input_hash, output_hash)
+
+    def run_jsonl(self, executor, source, dest):
+        try:
+            input_hash = file_hash(source)
+            if input_hash in self.unchanged(source, dest):
+                self.stats["skipped"] += 1
+                return
+            pending = deque()
+            invalid = self.stats["invalid_lines"]
+            with open(source, "rb") as file, AtomicWriter(dest, mode_from=source) as out:
+                for batch in read_batches(file):
+                    self.stats["records"] += len(batch)
+                    self.stats["bytes"] += sum(len(line) for line in batch)
+                    pending.append(executor.submit(optimize_records, batch, self.field))
+                    # A couple of batches per worker in flight bounds the memory
+                    if len(pending) >= 2 * self.workers:
+                        self.write_records(out, pending.popleft())
+                while pending:
+                    self.write_records(out, pending.popleft())
+            if self.stats["invalid_lines"] > invalid:
+                print("%s: %d lines are not valid JSON, copied unchanged" % (
+                    source, self.stats["invalid_lines"] - invalid), file=sys.stderr)
+        except Exception as error:
+            self.error(source, error)
+            return
+        self.stats["optimized"] += 1
+        self.record(source, input_hash, out.hash.hexdigest())
+
+    def write_records(self, out, future):
+        lines, invalid = future.result()
+        self.stats["invalid_lines"] += invalid
+        for line in lines:
+            out.write(line)
+
+    def error(self, source, error):
+        self.stats["errors"] += 1
+        print("%s: %s" % (source, error), file=sys.stderr)
+
+    def save_manifest(self):
+        if not self.manifest_path:
+            return
+        with AtomicWriter(self.manifest_path) as out:
+            out.write(json.dumps(self.manifest, indent=1, sort_keys=True).encode("utf-8"))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m text_optimizer",
+                                     description="Optimize chatbot text files, directory trees and JSONL archives")
+    parser.add_argument("paths", nargs="+", help="files and directories to optimize")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("-o", "--output", help="write results to this directory")
+    target.add_argument("-i", "--in-place", action="store_true", help="overwrite the input files")
+    parser.add_argument("--field", default="content",
+                        help="field of JSONL records to optimize, dotted for nested fields (default: content)")
+    parser.add_argument("--pattern", action="append",
+                        help="file name pattern to pick up in directories (default: %s)" % " ".join(DEFAULT_PATTERNS))
+    parser.add_argument("--manifest", help="content-hash manifest, files unchanged since the last run are skipped")
+    parser.add_argument("--workers", type=int, default=0, help="worker processes (default: one per core)")
+    parser.add_argument("--large-bytes", type=int, default=LARGE_BYTES,
+                        help="memory-map and stream files of at least this size")
+    parser.add_argument("--parallel-bytes", type=int, default=PARALLEL_BYTES,
+                        help="optimize files of at least this size on all workers at once")
+    args = parser.parse_args(argv)
+
+    bulk = BulkOptimizer(output=args.output, field=args.field, workers=args.workers or None,
+                         manifest=args.manifest, large_bytes=args.large_bytes,
+                         patterns=tuple(args.pattern or DEFAULT_PATTERNS), parallel_bytes=args.parallel_bytes)
+    started = time.perf_counter()
+    stats = bulk.run(args.paths)
+    seconds = time.perf_counter() - started
+    print("%d optimized, %d skipped, %d errors, %d records, %d invalid lines, %.1f MB in %.2fs (%.1f MB/s)" % (
+        stats["optimized"], stats["skipped"], stats["errors"], stats["records"], stats["invalid_lines"],
+        stats["bytes"] / 1e6, seconds, stats["bytes"] / 1e6 / seconds if seconds else 0), file=sys.stderr)
+    # Only files that failed fail the run; invalid lines were copied as they are
+    return 1 if stats["errors"] else 0
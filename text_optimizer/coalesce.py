@@ -0,0 +1,75 @@
+# Latest-wins scheduling of documents per client, for asyncio servers.
+#
+# An editor that posts its text on every keystroke only ever needs the
+# answer to its newest text. A Coalescer keeps at most one document per
+# client being optimized and one waiting: a newer document replaces the
+# waiting one, and every older request of that client is answered with
+# Superseded at once instead of being computed. A document that is already
+# being optimized (in a thread or worker process) runs to the end, but its
+# result is dropped. So the work grows with the number of clients typing,
+# not with the number of keystrokes.
+import asyncio
+
+
+class Superseded(Exception):
+    # A newer document from the same client arrived before this one was done
+    def __init__(self):
+        super().__init__("superseded by a newer request")
+
+
+class Client:
+    def __init__(self):
+        self.waiting = None  # (text, future) to optimize next
+        self.current = None  # future of the document being optimized
+        self.running = False
+
+
+class Coalescer:
+    # optimize is a blocking function, run on executor (None is the event
+    # loop's default thread pool)
+    def __init__(self, optimize, executor=None):
+        self.optimize = optimize
+        self.executor = executor
+        self.clients = {}
+
+    async def submit(self, key, text):
+        loop = asyncio.get_running_loop()
+        client = self.clients.get(key)
+        if client is None:
+            client = self.clients[key] = Client()
+        for older in (client.waiting and client.waiting[1], client.current):
+            if older is not None and not older.done():
+                older.set_exception(Superseded())
+        future = loop.create_future()
+        client.waiting = (text, future)
+        if not client.running:
+            client.running = True
+            loop.create_task(self.drain(key, client))
+        return await future
+
+    async def drain(self, key, client):
+        loop = asyncio.get_running_loop()
+        try:
+            while client.waiting is not None:
+                text, future = client.waiting
+                client.waiting = None
+                if future.done():
+                    continue  # superseded, or the request went away
+                client.current = future
+                try:
+                    result = await loop.run_in_executor(self.executor, self.optimize, text)
+                except Exception as error:
+                    if not future.done():
+                        future.set_exception(error)
+                else:
+                    if not future.done():
+                        future.set_result(result)
+                client.current = None
+        finally:
+            client.running = False
+            if client.waiting is None and self.clients.get(key) is client:
+                del self.clients[key]
+
+    def active(self):
+        # Clients with a document being optimized or waiting
+        return len(self.clients)
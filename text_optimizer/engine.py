@@ -0,0 +1,949 @@
+# Shared optimizer engine used by both the Flask and the PySide front-ends.
+#
+# The old optimize_text walked the whole document five times (character
+# filter, LaTeX sub, bracket sub, $$ split + paren sub, line cleanup) and built
+# a full copy of the string after every pass. Here the same rules run as a
+# chain of small stages: the input is handed to the first stage once, each
+# stage cuts what it receives into text and math spans, converts the spans
+# and pushes the result on to the next stage joined into one piece, and only
+# the final pieces are joined. Every stage looks for
+# its own delimiters with str.find, so no stage ever re-reads text it has
+# already passed on.
+#
+# The stages see exactly what the old passes saw (a later stage still sees the
+# "$...$" produced by an earlier one), so the output is identical to the old
+# function, including its corner cases.
+#
+# The cost is linear in the size of the input. No stage ever moves backwards,
+# with one exception: when DelimiterStage reaches the end with a \( or \[ still
+# open, it rescans the text that followed it, at most once per delimiter kind.
+# An opener without a closer is never retried opener by opener: if there is no
+# valid closer after it, there is none after any later opener either, which
+# is exactly the case that made the old lazy regexes quadratic on text with
+# stray "(" or "[". benchmarks/pathological.py checks this on adversarial input.
+#
+# Markdown code is left alone: right after sanitizing, CodeStage sends fenced
+# blocks and `inline code` straight to the line cleanup, so the math rules
+# only ever see the prose between them (and no span reaches into or across
+# code). Optimizer(skip_code=False) runs the rules over code too, like the
+# old function.
+#
+# optimize_text sanitizes the input first and checks which openers occur in
+# it at all; the stages of rules that cannot match are left out of the chain
+# (see active_rules), so plain prose or code only pays for the sanitize and
+# line cleanup passes.
+#
+# What gets rewritten is described by the tables in rules.py. An Optimizer
+# compiles them once (fused opener automata, one regex for all the content
+# cleanups, one for the math check) and can then be run on any number of
+# documents; optimize_text uses a shared default instance.
+import itertools
+import re
+import string
+import threading
+import zlib
+
+from .rules import (CONTENT_REWRITES, ESCAPES, INLINE_MAX_LENGTH, INLINE_SHORT_WORD,
+                    MATH_SYMBOLS, RULES, WRAPPERS)
+
+# Raised whenever a change makes the same input come out differently; part
+# of Optimizer.version, which servers put in their cache validators
+VERSION = 1
+
+# Unprintable characters are dropped, except these (needed for indentation)
+KEEP_WHITESPACE = "\n\t "
+
+# Opening line of a fenced code block, up to three spaces in
+FENCE = re.compile(r"^ {0,3}(`{3,}|~{3,})", re.M)
+
+BACKTICKS = re.compile(r"`+")
+
+
+# Remove trailing whitespace from every line that ends with a newline (a
+# final line without one keeps it). Splitting into lines is much faster than
+# a [ \t]+\n regex, which starts a match at every blank of the text.
+def strip_line_ends(text):
+    lines = text.split("\n")
+    last = lines.pop()
+    lines = [line.rstrip(" \t") for line in lines]
+    lines.append(last)
+    return "\n".join(lines)
+
+
+# Multiprocessing context of the worker pools (batch, parallel, workers).
+# Their processes are spawned fresh instead of forked: the servers start
+# pools from threaded code, and a fork copies only the forking thread, with
+# any lock another thread held at that moment stuck forever in the child.
+# multiprocessing is imported here, not at the top, so front-ends that never
+# start a pool do not pay for it.
+def spawn_context():
+    import multiprocessing
+    return multiprocessing.get_context("spawn")
+
+
+class DeletionTable(dict):
+    # str.translate table deleting every character that is neither printable
+    # nor in KEEP_WHITESPACE. Entries are filled in as characters are first
+    # seen (kept ones map to themselves, so translate never has to fall back
+    # on a missing key); the full table would have a million entries.
+    def __missing__(self, code):
+        char = chr(code)
+        value = code if char.isprintable() or char in KEEP_WHITESPACE else None
+        self[code] = value
+        return value
+
+
+DELETIONS = DeletionTable()
+for code in range(128):
+    DELETIONS[code]
+
+
+# Remove unprintable characters, allow newlines, tabs, and spaces for indentation
+def sanitize(text):
+    if not text.isascii():
+        # Most non-ASCII text has nothing to remove, which str.isprintable
+        # tells without a Python-level loop once the kept whitespace is out of the way
+        if text.replace("\n", " ").replace("\t", " ").isprintable():
+            return text
+    # ASCII text goes through CPython's cached fast path for ASCII tables
+    cleaned = text.translate(DELETIONS)
+    return text if len(cleaned) == len(text) else cleaned
+
+
+class Optimizer:
+    # The rule tables compiled into the automata the stages use. Building one
+    # is the expensive part, run() only creates a handful of small stages.
+    def __init__(self, rules=RULES, skip_code=True):
+        self.rules = tuple(rules)
+        self.skip_code = skip_code
+
+        # Consecutive rules with two-character delimiters share one stage and
+        # one fused opener automaton, every other rule gets a stage of its own
+        self.groups = []
+        for two_chars, group in itertools.groupby(self.rules, lambda rule: len(rule.opener) == 2):
+            group = tuple(group)
+            if two_chars:
+                self.groups.append((DelimiterStage, group, self.fuse_openers(group)))
+            else:
+                for rule in group:
+                    stage = SegmentedSpanStage if rule.outside else SpanStage
+                    self.groups.append((stage, rule, None))
+
+        self.by_opener = {rule.opener: rule for rule in self.rules}
+        # First characters of two-character delimiters, held back at the end
+        # of a piece in case the rest of the delimiter starts the next one
+        self.delimiter_prefixes = frozenset(delimiter[0] for rule in self.rules
+                                            for delimiter in (rule.opener, rule.closer)
+                                            if len(delimiter) == 2)
+
+        # Rules of the first group see the sanitized input itself; later ones
+        # may also see what earlier stages write
+        self.first_rules = frozenset(self.groups[0][1] if self.groups[0][0] is DelimiterStage else (self.groups[0][1],))
+        self.producible = frozenset("".join(WRAPPERS.values()) + "".join(ESCAPES.values()) + "".join(
+            literal for _, _, template in CONTENT_REWRITES for literal, _, _, _ in string.Formatter().parse(template)))
+
+        self.math_symbols = re.compile(r"\\[a-zA-Z]|[" + re.escape(MATH_SYMBOLS) + "]")
+        self.content_rewrite = re.compile("|".join(f"(?P<{name}>{pattern})"
+                                                   for name, pattern, _ in CONTENT_REWRITES))
+        self.templates = {name: template for name, _, template in CONTENT_REWRITES}
+        self.local = threading.local()
+
+        # Engine version and a checksum of the rules and options: equal for
+        # optimizers that turn the same input into the same output
+        setup = repr((self.rules, self.skip_code, CONTENT_REWRITES, ESCAPES, INLINE_MAX_LENGTH, INLINE_SHORT_WORD,
+                      MATH_SYMBOLS, WRAPPERS))
+        self.version = "%d.%08x" % (VERSION, zlib.crc32(setup.encode("utf-8")))
+
+    @staticmethod
+    def fuse_openers(rules):
+        # One alternation of all openers for every set of rules that can still
+        # match (a rule drops out once its closer is known not to occur again)
+        openers = {}
+        for size in range(len(rules) + 1):
+            for subset in itertools.combinations(rules, size):
+                pattern = "|".join(re.escape(rule.opener) for rule in subset)
+                openers[subset] = re.compile(pattern) if subset else None
+        return openers
+
+    def rewrite(self, match):
+        return self.templates[match.lastgroup].format_map(match.groupdict())
+
+    # Process math content: strip whitespace, fix artifacts, escape underscores
+    def process_math_content(self, content):
+        content = self.content_rewrite.sub(self.rewrite, content.strip())
+        for char, escaped in ESCAPES.items():
+            content = content.replace(char, escaped)
+        return content
+
+    def is_math(self, content):
+        return self.math_symbols.search(content) is not None
+
+    # Markdown for a delimited span, or None if it should stay unchanged
+    def replacement(self, rule, raw):
+        content = raw.strip()
+        if rule.heuristic == "inline":
+            # Skip if too long, empty, already processed (contains $), or an
+            # abbreviation like (CE)
+            if len(content) > INLINE_MAX_LENGTH or not content or "$" in content:
+                return None
+            if content.isupper() and len(content) > 1:
+                return None
+            is_short_variable = len(content.split()) == 1 and len(content) < INLINE_SHORT_WORD
+            if not (is_short_variable or self.is_math(content)):
+                return None
+        elif rule.heuristic == "display":
+            if not self.is_math(content):
+                return None
+        wrapper = WRAPPERS[rule.kind]
+        return f"{wrapper}{self.process_math_content(content)}{wrapper}"
+
+    # Chain the stages in the order the old passes ran; without lines the
+    # sink gets the pieces before the line cleanup. code=False leaves out the
+    # CodeStage, for text known to have no Markdown code.
+    def pipeline(self, sink, lines=True, rules=None, sanitize=True, code=True):
+        code = code and self.skip_code
+        tail = LineStage(sink) if lines else sink
+        stage = Junction(tail) if code else tail
+        for _, build in reversed(self.stages(False, rules, sanitize=False)):
+            stage = build(stage)
+        if code:
+            stage = CodeStage(stage, tail)
+        return SanitizeStage(stage) if sanitize else stage
+
+    # The stages of pipeline() one by one, as (name, function building the
+    # stage on a sink), to run or measure every stage on its own (the rule
+    # stages with run_segments, over code_segments). rules limits the stages
+    # to those rules (see active_rules).
+    def stages(self, lines=True, rules=None, sanitize=True):
+        stages = [("sanitize", SanitizeStage)] if sanitize else []
+        for cls, group, openers in self.groups:
+            if cls is DelimiterStage:
+                name = "+".join(rule.name for rule in group)
+                if rules is not None:
+                    group = tuple(rule for rule in group if rule in rules)
+                    if not group:
+                        continue
+            else:
+                name = group.name
+                if rules is not None and group not in rules:
+                    continue
+            stages.append((name, lambda sink, cls=cls, group=group, openers=openers: cls(sink, self, group, openers)))
+        if lines:
+            stages.append(("lines", LineStage))
+        return stages
+
+    # Prose and code of text (already sanitized) as CodeStage splits them:
+    # (is_code, piece) pairs, prose and code alternating
+    def code_segments(self, text):
+        if not self.skip_code:
+            return [(False, text)]
+        index = CodeIndex()
+        index.feed(text)
+        index.flush()
+        return index.segments
+
+    # The rules that can match in text (already sanitized). A rule whose
+    # opener does not occur anywhere in it is left out, unless an earlier
+    # stage could produce the opener: stages only remove characters or add
+    # the ones in wrappers, escapes and rewrite templates, so "(" and "["
+    # never appear out of nowhere, and \( \[ are looked for first.
+    def active_rules(self, text):
+        return tuple(rule for rule in self.rules if rule.opener in text
+                     or (rule not in self.first_rules and not self.producible.isdisjoint(rule.opener)))
+
+    # What the pre-scan found in text, for clients to cache or route on:
+    # which rules' openers occur and the provider style it looks like
+    def classify(self, text):
+        text = sanitize(text)
+        found = {rule.name: rule.opener in text for rule in self.rules}
+        latex = "\\(" in text or "\\[" in text
+        bare = text.count("(") > text.count("\\(") or text.count("[") > text.count("\\[")
+        style = {(False, False): "plain", (True, False): "latex", (False, True): "bare", (True, True): "mixed"}
+        return {"openers": found, "style": style[latex, bare]}
+
+    def run(self, text):
+        text = sanitize(text)
+        rules = self.active_rules(text)
+        # Text without a backtick or ~~~ has no code to look for
+        code = self.skip_code and ("`" in text or "~~~" in text)
+        # Stages are back in their initial state after flush(), so every
+        # thread keeps one pipeline per set of rules around instead of
+        # building it per call
+        pipelines = getattr(self.local, "pipelines", None)
+        if pipelines is None:
+            pipelines = self.local.pipelines = {}
+        key = (rules, code)
+        cached = pipelines.pop(key, None)
+        if cached is None:
+            collector = Collector()
+            cached = (self.pipeline(collector, rules=rules, sanitize=False, code=code), collector)
+        pipeline, collector = cached
+        pipeline.feed(text)
+        pipeline.flush()
+        pipelines[key] = cached
+        return collector.text()
+
+
+class Stage:
+    # A step of the pipeline: receives pieces of text with feed(), pushes its
+    # output to the next stage, and releases whatever it still holds on flush(),
+    # which also ends the document and leaves the stage ready for the next one.
+    # Output is collected in self.out while a piece is worked on and passed on
+    # joined at the end of feed() (push), so the next stage gets one large
+    # piece per call instead of a call per bit of text between two spans.
+    def __init__(self, sink):
+        self.sink = sink
+        self.out = []
+
+    def emit(self, piece):
+        self.out.append(piece)
+
+    def push(self):
+        out = self.out
+        if out:
+            text = "".join(out)
+            out.clear()
+            if text:
+                self.sink.feed(text)
+
+    def feed(self, piece):
+        raise NotImplementedError
+
+    def flush(self):
+        self.push()
+        self.sink.flush()
+
+    # True when neither this stage nor the ones after it hold anything back,
+    # i.e. the pipeline is in the same state as at the start of a document
+    def idle(self):
+        return self.sink.idle()
+
+
+class Collector:
+    # End of the pipeline, keeps the finished pieces
+    def __init__(self):
+        self.parts = []
+
+    def feed(self, piece):
+        self.parts.append(piece)
+
+    def flush(self):
+        pass
+
+    def idle(self):
+        return True
+
+    def text(self):
+        text = "".join(self.parts)
+        self.parts = []
+        return text
+
+
+class Junction(Stage):
+    # Where code rejoins the output of the rule stages: passes their pieces
+    # on but not their flush, which ends a stretch of prose, not the document
+    def feed(self, piece):
+        self.sink.feed(piece)
+
+    def flush(self):
+        pass
+
+
+# Run one stage on its own over (is_code, piece) segments the way the
+# pipeline runs it: code passes through, every stretch of prose is a document
+# of its own. Returns the segments of its output.
+def run_segments(build, segments, collector=None):
+    collector = Collector() if collector is None else collector
+    stage = build(collector)
+    output = []
+    for code, piece in segments:
+        if code:
+            collector.feed(piece)
+        else:
+            stage.feed(piece)
+            stage.flush()
+        output.append((code, collector.text()))
+    return output
+
+
+def line_end(text, pos):
+    end = text.find("\n", pos)
+    return len(text) if end < 0 else end + 1
+
+
+# (start, end) of the inline code spans between start and stop, one line: a
+# run of backticks opens a span that the next run of the same length closes;
+# a run without one is plain text
+def code_spans(text, start, stop):
+    runs = [match.span() for match in BACKTICKS.finditer(text, start, stop)]
+    closers = [None] * len(runs)
+    next_of_size = {}
+    for index in range(len(runs) - 1, -1, -1):
+        size = runs[index][1] - runs[index][0]
+        closers[index] = next_of_size.get(size)
+        next_of_size[size] = index
+    index = 0
+    while index < len(runs):
+        closer = closers[index]
+        if closer is None:
+            index += 1
+        else:
+            yield runs[index][0], runs[closer][1]
+            index = closer + 1
+
+
+class CodeStage(Stage):
+    # Markdown code: fenced blocks (``` or ~~~, closed by a fence at least as
+    # long, or the end) and `inline code` go to code_sink, the line cleanup,
+    # and only the prose between them to the rule stages. Those are flushed
+    # before every piece of code, through a Junction, so each stretch of
+    # prose is a document of its own to them. Inline code ends on the line it
+    # starts.
+    #
+    # Whole lines are scanned as they come. Of the line not finished yet,
+    # only what can still change its meaning is held back: its head while it
+    # may still open or close a fence (up to three spaces and a run of ` or
+    # ~), the whole line once it looks like a ``` opener, or in prose the text
+    # from a run of backticks that has not been closed yet. Everything else
+    # is passed on right away (a line in a fenced block is code either way),
+    # and what is held is kept in a list and joined once.
+    def __init__(self, sink, code_sink):
+        super().__init__(sink)
+        self.code_sink = code_sink
+        self.fence = None  # closing line of the open fenced block, as a regex
+        self.fence_mark = None  # and the run of ` or ~ that opened it
+        self.prose_open = False  # prose passed on since the rule stages were flushed
+        self.line = []  # the part of the unfinished line held back
+        self.start_line()
+
+    def start_line(self):
+        # head: the line may still be a fence; code: it is code to its end;
+        # closing: a closing fence so far; hold: a ``` line, held to its end;
+        # prose: prose, self.line is held from a backtick run not closed yet
+        self.kind = "head"
+        self.indent = 0  # spaces at the start of the line
+        self.run = 0  # length of the run of ` or ~ after them
+        self.run_char = None
+        self.opener = None  # in prose: length of the backtick run self.line starts with
+        self.ticks = 0  # in prose: backticks at the end so far, the run may go on
+
+    def feed(self, piece):
+        end = piece.rfind("\n") + 1
+        if not end:
+            self.extend(piece)
+            return
+        if self.kind == "head" and not self.line:
+            # At the start of a line
+            self.scan(piece[:end])
+        else:
+            first = piece.find("\n") + 1
+            self.end_line(piece[:first])
+            if first < end:
+                self.scan(piece[first:end])
+        if end < len(piece):
+            self.extend(piece[end:])
+
+    # The rest of the unfinished line, up to and including its newline (none
+    # at the end of the document)
+    def end_line(self, rest):
+        kind = self.kind
+        if self.ticks:
+            self.line.append("`" * self.ticks)
+        text = "".join(self.line) + rest if self.line else rest
+        self.line = []
+        self.start_line()
+        if kind == "prose":
+            self.prose(text, 0, len(text))
+        elif kind == "code":
+            if text:
+                self.code(text)
+        else:
+            # Held from the start of the line
+            self.scan(text)
+
+    # More of the unfinished line, without a newline
+    def extend(self, piece):
+        kind = self.kind
+        if kind == "code":
+            self.code(piece)
+        elif kind == "prose":
+            self.inline(piece)
+        elif kind == "hold":
+            self.line.append(piece)
+        elif kind == "closing":
+            if piece.strip(" \t"):
+                self.kind = "code"
+                self.release_code(piece)
+            else:
+                self.line.append(piece)
+        else:
+            self.head(piece)
+
+    # Prose: text goes on until a backtick run, which is held with what
+    # follows until the next run of the same length closes it, as code_spans
+    # pairs them
+    def inline(self, piece):
+        pos = len(piece) - len(piece.lstrip("`"))
+        if pos == len(piece):
+            self.ticks += pos
+            return
+        if self.ticks or pos:
+            self.end_run(self.ticks + pos)
+            self.ticks = 0
+        while pos < len(piece):
+            tick = piece.find("`", pos)
+            stop = len(piece) if tick < 0 else tick
+            if self.opener is None:
+                self.text(piece[pos:stop])
+            elif stop > pos:
+                self.line.append(piece[pos:stop])
+            if tick < 0:
+                return
+            pos = len(piece) - len(piece[tick:].lstrip("`"))
+            if pos == len(piece):
+                self.ticks = pos - tick
+                return
+            self.end_run(pos - tick)
+
+    def end_run(self, size):
+        if self.opener is None:
+            self.opener = size
+            self.line.append("`" * size)
+        elif size == self.opener:
+            self.line.append("`" * size)
+            text = "".join(self.line)
+            self.line = []
+            self.opener = None
+            self.code(text)
+        else:
+            self.line.append("`" * size)
+
+    def head(self, piece):
+        self.line.append(piece)
+        pos = 0
+        if not self.run:
+            spaces = len(piece) - len(piece.lstrip(" "))
+            self.indent += spaces
+            pos = spaces
+            if self.indent > 3:
+                return self.decide("")
+            if pos == len(piece):
+                return
+            if piece[pos] not in "`~":
+                return self.decide(piece[pos:])
+            self.run_char = piece[pos]
+        rest = piece[pos:].lstrip(self.run_char)
+        self.run += len(piece) - pos - len(rest)
+        if rest:
+            self.decide(rest)
+
+    # The head of the line is known: rest is what followed it in the last piece
+    def decide(self, rest):
+        fence = self.fence
+        if fence is None:
+            if self.run >= 3 and self.run_char == "~":
+                self.open_fence(self.run_char * self.run)
+                self.kind = "code"
+                self.release_code("")
+            elif self.run >= 3:
+                # ```info or ```inline code```, only the end of the line tells
+                self.kind = "hold"
+            else:
+                self.kind = "prose"
+                text = "".join(self.line)
+                self.line = []
+                self.extend(text)
+        elif self.run_char == self.fence_mark[0] and self.run >= len(self.fence_mark) and not rest.strip(" \t"):
+            self.kind = "closing"
+        else:
+            self.kind = "code"
+            self.release_code("")
+
+    def release_code(self, piece):
+        text = "".join(self.line) + piece
+        self.line = []
+        if text:
+            self.code(text)
+
+    def open_fence(self, mark):
+        self.fence_mark = mark
+        self.fence = re.compile(r"^ {0,3}%s{%d,}[ \t]*$" % (re.escape(mark[0]), len(mark)), re.M)
+
+    def scan(self, text):
+        if self.fence is None and "`" not in text and "~~~" not in text:
+            self.prose(text, 0, len(text))
+            return
+        pos = 0
+        while pos < len(text):
+            if self.fence is not None:
+                match = self.fence.search(text, pos)
+                end = len(text) if match is None else line_end(text, match.end())
+                self.code(text[pos:end])
+                if match is not None:
+                    self.fence = self.fence_mark = None
+                pos = end
+            else:
+                match = self.opening_fence(text, pos)
+                if match is None:
+                    self.prose(text, pos, len(text))
+                    return
+                self.prose(text, pos, match.start())
+                self.open_fence(match.group(1))
+                end = line_end(text, match.end())
+                self.code(text[match.start():end])
+                pos = end
+
+    @staticmethod
+    def opening_fence(text, pos):
+        while True:
+            match = FENCE.search(text, pos)
+            if match is None or match.group(1)[0] == "~":
+                return match
+            # ```code``` on one line is inline code, not a fence
+            end = line_end(text, match.end())
+            if "`" not in text[match.end():end]:
+                return match
+            pos = end
+
+    def prose(self, text, pos, end):
+        search = pos
+        while True:
+            tick = text.find("`", search, end)
+            if tick < 0:
+                break
+            newline = text.rfind("\n", search, tick)
+            stop = text.find("\n", tick, end)
+            stop = end if stop < 0 else stop
+            for start, finish in code_spans(text, search if newline < 0 else newline + 1, stop):
+                self.text(text[pos:start])
+                self.code(text[start:finish])
+                pos = finish
+            search = stop
+        self.text(text[pos:end])
+
+    def text(self, piece):
+        if piece:
+            self.prose_open = True
+            self.sink.feed(piece)
+
+    def code(self, piece):
+        if self.prose_open:
+            self.sink.flush()
+            self.prose_open = False
+        self.code_sink.feed(piece)
+
+    def flush(self):
+        self.end_line("")
+        self.fence = self.fence_mark = None
+        self.sink.flush()
+        self.prose_open = False
+        self.code_sink.flush()
+
+    def idle(self):
+        return self.kind == "head" and not self.line and self.fence is None and self.sink.idle()
+
+
+class CodeIndex(CodeStage):
+    # A CodeStage on its own, collecting (is_code, piece) segments
+    def __init__(self):
+        super().__init__(None, None)
+        self.segments = []
+
+    def add(self, code, piece):
+        if self.segments and self.segments[-1][0] == code:
+            self.segments[-1] = (code, self.segments[-1][1] + piece)
+        else:
+            self.segments.append((code, piece))
+
+    def text(self, piece):
+        if piece:
+            self.add(False, piece)
+
+    def code(self, piece):
+        self.add(True, piece)
+
+    def flush(self):
+        self.end_line("")
+        self.fence = self.fence_mark = None
+
+
+class SanitizeStage(Stage):
+    # Remove unprintable characters, allow newlines, tabs, and spaces for indentation
+    def feed(self, piece):
+        piece = sanitize(piece)
+        if piece:
+            self.sink.feed(piece)
+
+
+class DelimiterStage(Stage):
+    # Two-character delimiters such as \( \) and \[ \] (used in Grok-like
+    # content); every span found is converted
+    def __init__(self, sink, optimizer, rules, openers):
+        super().__init__(sink)
+        self.optimizer = optimizer
+        self.all_rules = rules
+        self.rules = rules  # rules whose closer may still appear later on
+        self.openers = openers
+        self.opener = openers[rules]
+        self.rule = None  # rule of the open span, if any
+        self.buffer = []
+        self.carry = ""  # last character, may start a delimiter in the next piece
+
+    def feed(self, piece):
+        if not piece:
+            return
+        if self.carry:
+            piece = self.carry + piece
+            self.carry = ""
+        if piece[-1] in self.optimizer.delimiter_prefixes:
+            self.carry = piece[-1]
+            piece = piece[:-1]
+        self.scan(piece)
+        self.push()
+
+    def scan(self, piece):
+        emit = self.out.append
+        replacement = self.optimizer.replacement
+        pos = 0
+        rule = self.rule
+        if rule is not None:
+            # A span left open by the last piece
+            end = piece.find(rule.closer)
+            if end < 0:
+                self.buffer.append(piece)
+                return
+            self.buffer.append(piece[:end])
+            raw = "".join(self.buffer)
+            self.buffer = []
+            self.rule = None
+            emit(replacement(rule, raw) or rule.opener + raw + rule.closer)
+            pos = end + len(rule.closer)
+        if self.opener is None:
+            emit(piece[pos:])
+            return
+        search = self.opener.search
+        by_opener = self.optimizer.by_opener
+        while True:
+            match = search(piece, pos)
+            if match is None:
+                emit(piece[pos:])
+                return
+            emit(piece[pos:match.start()])
+            rule = by_opener[match.group()]
+            start = match.end()
+            end = piece.find(rule.closer, start)
+            if end < 0:
+                self.rule = rule
+                self.buffer.append(piece[start:])
+                return
+            raw = piece[start:end]
+            emit(replacement(rule, raw) or rule.opener + raw + rule.closer)
+            pos = end + len(rule.closer)
+
+    def flush(self):
+        if self.carry:
+            self.scan(self.carry)
+            self.carry = ""
+        while self.rule is not None:
+            # The span never closed, so neither will any later one of the same
+            # kind: keep the opener as text and rescan what followed it.
+            rule = self.rule
+            rest = "".join(self.buffer)
+            self.buffer = []
+            self.rule = None
+            self.rules = tuple(r for r in self.rules if r is not rule)
+            self.opener = self.openers[self.rules]
+            self.emit(rule.opener)
+            self.scan(rest)
+        self.rules = self.all_rules
+        self.opener = self.openers[self.rules]
+        super().flush()
+
+    def idle(self):
+        return self.rule is None and not self.carry and self.sink.idle()
+
+
+class SpanStage(Stage):
+    # One-character delimiters such as ChatGPT-style display math [ math ];
+    # a closer directly after rule.not_after (\big]) does not count
+    def __init__(self, sink, optimizer, rule, openers=None):
+        super().__init__(sink)
+        self.optimizer = optimizer
+        self.rule = rule
+        self.open = False
+        self.buffer = []
+        self.tail = ""  # last characters seen, for the not_after check across pieces
+
+    def closing(self, piece, pos, end):
+        close = piece.find(self.rule.closer, pos, end)
+        not_after = self.rule.not_after
+        if not not_after:
+            return close
+        size = len(not_after)
+        while close >= 0:
+            before = piece[close - size:close] if close >= size else (self.tail + piece[:close])[-size:]
+            if before != not_after:
+                return close
+            close = piece.find(self.rule.closer, close + 1, end)
+        return -1
+
+    def feed(self, piece):
+        self.scan(piece, 0, len(piece))
+        if self.rule.not_after:
+            self.remember(piece)
+        self.push()
+
+    def remember(self, piece):
+        size = len(self.rule.not_after)
+        self.tail = piece[-size:] if len(piece) >= size else (self.tail + piece)[-size:]
+
+    def scan(self, piece, pos, end):
+        emit = self.out.append
+        replacement = self.optimizer.replacement
+        rule = self.rule
+        opener, closer = rule.opener, rule.closer
+        if self.open:
+            # A span left open by the last piece
+            close = self.closing(piece, pos, end)
+            if close < 0:
+                self.buffer.append(piece[pos:end])
+                return
+            self.buffer.append(piece[pos:close])
+            raw = "".join(self.buffer)
+            self.buffer = []
+            self.open = False
+            emit(replacement(rule, raw) or opener + raw + closer)
+            pos = close + 1
+        find = piece.find
+        closing = self.closing if rule.not_after else None
+        while True:
+            start = find(opener, pos, end)
+            if start < 0:
+                emit(piece[pos:end])
+                return
+            emit(piece[pos:start])
+            close = closing(piece, start + 1, end) if closing else find(closer, start + 1, end)
+            if close < 0:
+                self.open = True
+                self.buffer.append(piece[start + 1:end])
+                return
+            raw = piece[start + 1:close]
+            emit(replacement(rule, raw) or opener + raw + closer)
+            pos = close + 1
+
+    def release(self):
+        # No valid closer after the opener, so none after any later opener
+        # either: everything from the opener on stays unchanged
+        if self.open:
+            self.emit(self.rule.opener + "".join(self.buffer))
+            self.buffer = []
+            self.open = False
+
+    def flush(self):
+        self.release()
+        self.tail = ""
+        super().flush()
+
+    def idle(self):
+        return not self.open and self.sink.idle()
+
+
+class SegmentedSpanStage(SpanStage):
+    # A SpanStage that skips the regions between rule.outside delimiters, as
+    # ChatGPT-style inline math ( math ) is only applied outside of $$ ... $$
+    def __init__(self, sink, optimizer, rule, openers=None):
+        super().__init__(sink, optimizer, rule)
+        self.delimiter = rule.outside
+        self.inside = False
+        self.carry = False  # first half of a delimiter at the end of the last piece
+
+    def feed(self, piece):
+        pos = 0
+        if self.carry:
+            self.carry = False
+            if piece[0] == self.delimiter[1]:
+                self.toggle()
+                pos = 1
+            else:
+                self.text(self.delimiter[0], 0, 1)
+        while pos < len(piece):
+            delimiter = piece.find(self.delimiter, pos)
+            if delimiter < 0:
+                end = len(piece)
+                if piece[-1] == self.delimiter[0]:
+                    self.carry = True
+                    end -= 1
+                self.text(piece, pos, end)
+                break
+            self.text(piece, pos, delimiter)
+            self.toggle()
+            pos = delimiter + 2
+        if self.rule.not_after:
+            self.remember(piece)
+        self.push()
+
+    def toggle(self):
+        # A span still open at a delimiter has no closer in its segment, and
+        # neither has any later opener of that segment
+        self.release()
+        self.emit(self.delimiter)
+        self.inside = not self.inside
+
+    def text(self, piece, pos, end):
+        if self.inside:
+            self.emit(piece[pos:end])
+        else:
+            self.scan(piece, pos, end)
+
+    def flush(self):
+        if self.carry:
+            self.carry = False
+            self.text(self.delimiter[0], 0, 1)
+        self.inside = False
+        super().flush()
+
+    def idle(self):
+        return not (self.inside or self.carry) and super().idle()
+
+
+class LineStage(Stage):
+    # Remove trailing whitespace from every line, preserve blank lines and
+    # indentation, and drop the whitespace at the very end of the document.
+    # Pieces are only collected here and cleaned in one go when released, a
+    # single regex over the joined text is much cheaper than one per piece.
+    def __init__(self, sink):
+        super().__init__(sink)
+        self.parts = []
+        self.pending = ""  # whitespace that may turn out to be trailing
+
+    def feed(self, piece):
+        self.parts.append(piece)
+
+    def release(self):
+        text = self.pending + "".join(self.parts)
+        self.parts = []
+        body = text.rstrip(" \t\n")
+        self.pending = text[len(body):]
+        if " \n" in body or "\t\n" in body:
+            body = strip_line_ends(body)
+        if body:
+            self.sink.feed(body)
+
+    def flush(self):
+        self.release()
+        self.pending = ""
+        super().flush()
+
+    def idle(self):
+        return not (self.parts or self.pending) and self.sink.idle()
+
+
+default_optimizer = Optimizer()
+
+
+def process_math_content(content):
+    return default_optimizer.process_math_content(content)
+
+
+def optimize_text(raw_text):
+    return default_optimizer.run(raw_text)
@@ -0,0 +1,204 @@
+# Incremental re-optimization for live editing.
+#
+# The document is cut into runs: stretches of whole paragraphs after which the
+# pipeline holds nothing back (no math span, $$ region or delimiter left open),
+# so every run can be optimized on its own and its output reused as long as its
+# text does not change. After an edit only the runs from the edited one onward
+# are optimized again, and only until the new text lines up with an old run
+# boundary; everything after that is taken over as it was.
+#
+# Line cleanup is done per run: a run always ends right after a newline, so
+# trailing blanks never span two runs, and only the whitespace at the very end
+# of the document needs the whole picture.
+import re
+from collections import namedtuple
+
+from .engine import Collector, default_optimizer, strip_line_ends
+
+# Runs are cut after blank lines, or after any newline once a paragraph gets longer than this
+MAX_BLOCK = 16 * 1024
+
+BLANK_LINE = re.compile(r"\n[ \t\r]*\n")
+
+# A replacement of output[start:end] by text, offsets in the units the
+# IncrementalOptimizer was created with
+Patch = namedtuple("Patch", "start end text")
+
+
+class Run:
+    __slots__ = ("text", "output", "size", "closed", "spans")
+
+    def __init__(self, text, output, size, closed, spans=None):
+        self.text = text  # input of the run
+        self.output = output  # optimized, with trailing blanks of its lines removed
+        self.size = size  # length of output, in the optimizer's units
+        self.closed = closed  # ended after a newline with the pipeline idle
+        self.spans = spans  # spans counted in the run, if the pipeline counts them (metrics.TimedPipeline)
+
+
+def utf16_length(text):
+    return len(text.encode("utf-16-le", "surrogatepass")) // 2
+
+
+# Offsets of the part that differs between two texts: (start, old_end, new_end)
+def changed_range(old, new, step=4096):
+    limit = min(len(old), len(new))
+    start = 0
+    while start < limit and old[start:start + step] == new[start:start + step]:
+        start += step
+    while start < limit and old[start] == new[start]:
+        start += 1
+    start = min(start, limit)
+    old_end, new_end = len(old), len(new)
+    while old_end - step >= start and new_end - step >= start and old[old_end - step:old_end] == new[new_end - step:new_end]:
+        old_end -= step
+        new_end -= step
+    while old_end > start and new_end > start and old[old_end - 1] == new[new_end - 1]:
+        old_end -= 1
+        new_end -= 1
+    return start, old_end, new_end
+
+
+# Candidate run ends from pos on: after blank lines, or after a newline once a block grows too long
+def block_ends(text, pos, max_block=MAX_BLOCK):
+    while pos < len(text):
+        match = BLANK_LINE.search(text, pos, pos + max_block)
+        if match:
+            end = match.end()
+        else:
+            end = text.rfind("\n", pos, pos + max_block) + 1 or len(text)
+            if pos + max_block >= len(text):
+                end = len(text)
+        yield end
+        pos = end
+
+
+class IncrementalOptimizer:
+    # Keeps the optimized form of one document in sync with its edits.
+    # utf16=True measures output offsets in UTF-16 code units, as Qt and
+    # JavaScript count them; input offsets are always Python string indices.
+    def __init__(self, optimizer=default_optimizer, utf16=False, max_block=MAX_BLOCK):
+        self.optimizer = optimizer
+        self.measure = utf16_length if utf16 else len
+        self.max_block = max_block
+        self.text = ""
+        self.runs = []
+        self.size = 0  # length of the optimized document, in the same units
+
+    def output(self):
+        return "".join(run.output for run in self.runs).rstrip(" \t\n")
+
+    def reset(self, text):
+        self.text = ""
+        self.runs = []
+        self.size = 0
+        self.update(text)
+        return self.output()
+
+    # Bring the document up to date with text, given the edited range if it is
+    # known (start, and its end before and after the edit), and return the Patch
+    # that turns the previous output into the new one
+    def update(self, text, start=None, old_end=None, new_end=None):
+        old_text = self.text
+        if start is None or not self.valid_hint(old_text, text, start, old_end, new_end):
+            start, old_end, new_end = changed_range(old_text, text)
+        if start == old_end == new_end:
+            return Patch(self.size, self.size, "")
+        delta = new_end - old_end
+
+        # Runs entirely before the edit stay as they are
+        index = 0
+        pos = 0
+        out_pos = 0
+        while index < len(self.runs):
+            run = self.runs[index]
+            end = pos + len(run.text)
+            if end > start or (end == start and not run.closed):
+                break
+            pos = end
+            out_pos += run.size
+            index += 1
+
+        new_runs, old_next = self.optimize_from(text, pos, index, old_end, delta)
+        old_runs = self.runs[index:old_next]
+        tail = self.runs[old_next:]
+        self.runs[index:] = new_runs + tail
+        self.text = text
+
+        new_mid = "".join(run.output for run in new_runs)
+        old_size = self.size
+        if any(run.output.strip(" \t\n") for run in reversed(tail)):
+            # Something visible follows, the end of the document is untouched
+            self.size = old_size - sum(run.size for run in old_runs) + sum(run.size for run in new_runs)
+            return Patch(out_pos, out_pos + sum(run.size for run in old_runs), new_mid)
+
+        # The edit reaches the end of the document, where trailing whitespace
+        # is stripped, possibly including some from the runs before the edit:
+        # replace everything after the last visible character before it
+        spaces = []
+        for run in reversed(self.runs[:index]):
+            body = run.output.rstrip(" \t\n")
+            spaces.append(run.output[len(body):])
+            if body:
+                break
+        spaces = "".join(reversed(spaces))
+        patch_start = out_pos - self.measure(spaces)
+        rest = (spaces + new_mid + "".join(run.output for run in tail)).rstrip(" \t\n")
+        self.size = patch_start + self.measure(rest)
+        return Patch(patch_start, old_size, rest)
+
+    @staticmethod
+    def valid_hint(old_text, text, start, old_end, new_end):
+        return (0 <= start <= old_end <= len(old_text) and start <= new_end <= len(text)
+                and len(text) - new_end == len(old_text) - old_end)
+
+    # Optimize text from pos, a run boundary, until it lines up again with an
+    # old run boundary past the edit; returns the new runs and the index of
+    # the first old run that can be kept
+    def optimize_from(self, text, pos, index, old_end, delta):
+        collector = Collector()
+        pipeline = self.optimizer.pipeline(collector, lines=False)
+        runs = []
+        run_start = pos
+        old_index = index
+        old_pos = pos  # start of self.runs[old_index] in the old text
+        for end in block_ends(text, pos, self.max_block):
+            pipeline.feed(text[pos:end])
+            pos = end
+            if end == len(text) or not pipeline.idle():
+                continue
+            runs.append(self.make_run(text[run_start:end], collector.text(), True, pipeline))
+            run_start = end
+            if end - delta < old_end:
+                continue
+            # Past the edit: stop as soon as an old run starts at the same place
+            while old_index < len(self.runs) and old_pos < end - delta:
+                old_pos += len(self.runs[old_index].text)
+                old_index += 1
+            if old_pos == end - delta and old_index < len(self.runs):
+                # The pipeline is idle here, flushing it only ends the document
+                self.end(pipeline, index, old_index)
+                return runs, old_index
+        # The last run is never closed: its final line may still grow, and
+        # flush() may have rescanned it for openers that never closed
+        self.end(pipeline, index, len(self.runs))
+        if run_start < len(text):
+            runs.append(self.make_run(text[run_start:], collector.text(), False, pipeline))
+        return runs, len(self.runs)
+
+    # Flush the pipeline. One that counts spans is told first about the spans
+    # of the old runs start:stop it replaces, so that an edit only adds the
+    # spans it made to the count, not every span of the runs around it.
+    def end(self, pipeline, start, stop):
+        discount = getattr(pipeline, "discount", None)
+        if discount is not None:
+            for run in self.runs[start:stop]:
+                if run.spans:
+                    discount(run.spans)
+        pipeline.flush()
+
+    def make_run(self, text, output, closed, pipeline):
+        if " \n" in output or "\t\n" in output:
+            output = strip_line_ends(output)
+        found = getattr(pipeline, "found", None)
+        return Run(text, output, self.measure(output), closed, found() if found is not None else None)
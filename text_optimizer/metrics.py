@@ -0,0 +1,310 @@
+# Optional instrumentation: where the time goes in each document.
+#
+# Nothing here is used unless a front-end asks for it; the plain Optimizer has
+# no hooks at all, so leaving instrumentation off costs nothing.
+#
+# InstrumentedOptimizer.run runs the stages one after another over the whole
+# text instead of chaining them, which gives every stage its own wall time and
+# sizes (the output is the same, every stage gives the same result whether it
+# gets the text in one piece or in many), and skips the same rules as
+# Optimizer.run. Its pipeline(), which sessions and streams use, chains the
+# stages as usual with a Timer in front of each, and every flush() records a
+# document. Both count the spans every rule found and converted; pipelines
+# let IncrementalOptimizer take back the spans of runs it re-optimizes, so
+# editing a session counts only the spans the edit added. Everything is
+# collected in a Metrics registry that can be rendered in the Prometheus text
+# format.
+import bisect
+import copy
+import threading
+import time
+
+from .engine import RULES, CodeStage, Junction, LineStage, Optimizer, SanitizeStage, run_segments
+
+# Upper bounds of the duration histogram buckets, in seconds
+SECONDS_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    def __init__(self, buckets=SECONDS_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.documents = 0
+        self.document_seconds = Histogram()
+        self.stage_seconds = {}  # stage -> Histogram
+        self.stage_chars = {}  # stage -> [chars in, chars out]
+        self.spans = {}  # (rule, converted) -> count
+        self.last = {}  # stage -> seconds of the latest document
+        self.rejections = {}  # limit -> documents turned away
+
+    def observe_document(self, stages, seconds):
+        # stages: [(name, seconds, chars in, chars out), ...]
+        with self.lock:
+            self.documents += 1
+            self.document_seconds.observe(seconds)
+            self.last = {}
+            for name, elapsed, chars_in, chars_out in stages:
+                self.stage_seconds.setdefault(name, Histogram()).observe(elapsed)
+                chars = self.stage_chars.setdefault(name, [0, 0])
+                chars[0] += chars_in
+                chars[1] += chars_out
+                self.last[name] = elapsed
+
+    def count_span(self, rule, converted, count=1):
+        with self.lock:
+            key = (rule, converted)
+            self.spans[key] = self.spans.get(key, 0) + count
+
+    def count_rejection(self, limit):
+        with self.lock:
+            self.rejections[limit] = self.rejections.get(limit, 0) + 1
+
+    def summary(self):
+        # The numbers a status bar has room for
+        with self.lock:
+            return {
+                "documents": self.documents,
+                "last": dict(self.last),
+                "converted": sum(count for (_, converted), count in self.spans.items() if converted),
+                "kept": sum(count for (_, converted), count in self.spans.items() if not converted),
+            }
+
+    def render(self, cache=None):
+        # Prometheus text exposition format; cache is a ResultCache whose
+        # counters are included
+        lines = []
+        with self.lock:
+            lines += metric("text_optimizer_documents_total", "counter", "Documents optimized",
+                            [("", self.documents)])
+            lines += histogram("text_optimizer_document_seconds", "Wall time per document",
+                               [("", self.document_seconds)])
+            lines += histogram("text_optimizer_stage_seconds", "Wall time per pipeline stage",
+                               [(labels(stage=name), hist) for name, hist in self.stage_seconds.items()])
+            lines += metric("text_optimizer_stage_input_chars_total", "counter", "Characters into each stage",
+                            [(labels(stage=name), chars[0]) for name, chars in self.stage_chars.items()])
+            lines += metric("text_optimizer_stage_output_chars_total", "counter", "Characters out of each stage",
+                            [(labels(stage=name), chars[1]) for name, chars in self.stage_chars.items()])
+            lines += metric("text_optimizer_spans_total", "counter", "Delimited spans found per rule",
+                            [(labels(rule=rule, converted=str(converted).lower()), count)
+                             for (rule, converted), count in sorted(self.spans.items())])
+            lines += metric("text_optimizer_rejections_total", "counter", "Documents turned away per limit",
+                            [(labels(limit=limit), count) for limit, count in sorted(self.rejections.items())])
+        if cache is not None:
+            lines += render_cache(cache)
+        return "\n".join(lines) + "\n"
+
+
+def render_cache(cache):
+    stats = cache.stats()
+    lines = []
+    for name in ("hits", "misses", "evictions"):
+        lines += metric("text_optimizer_cache_%s_total" % name, "counter", "Result cache " + name,
+                        [("", stats[name])])
+    for name in ("entries", "bytes"):
+        lines += metric("text_optimizer_cache_%s" % name, "gauge", "Result cache " + name,
+                        [("", stats[name])])
+    return lines
+
+
+def labels(**values):
+    return "{" + ",".join('%s="%s"' % (key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                          for key, value in values.items()) + "}"
+
+
+def metric(name, kind, help, samples):
+    lines = ["# HELP %s %s" % (name, help), "# TYPE %s %s" % (name, kind)]
+    lines += ["%s%s %s" % (name, label, value) for label, value in samples]
+    return lines
+
+
+def histogram(name, help, samples):
+    lines = ["# HELP %s %s" % (name, help), "# TYPE %s histogram" % name]
+    for label, hist in samples:
+        inner = label[1:-1] + "," if label else ""
+        total = 0
+        for bound, count in zip(hist.buckets + ("+Inf",), hist.counts):
+            total += count
+            lines.append('%s_bucket{%sle="%s"} %d' % (name, inner, bound, total))
+        lines.append("%s_sum%s %r" % (name, label, hist.sum))
+        lines.append("%s_count%s %d" % (name, label, hist.count))
+    return lines
+
+
+class InstrumentedOptimizer(Optimizer):
+    def __init__(self, rules=RULES, metrics=None, skip_code=True):
+        super().__init__(rules, skip_code)
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.tally = None  # (rule, converted) -> count, in the copies a TimedPipeline counts with
+
+    def replacement(self, rule, raw):
+        result = super().replacement(rule, raw)
+        if self.tally is None:
+            self.metrics.count_span(rule.name, result is not None)
+        else:
+            key = (rule.name, result is not None)
+            self.tally[key] = self.tally.get(key, 0) + 1
+        return result
+
+    def pipeline(self, sink, lines=True, rules=None, sanitize=True, code=True):
+        return TimedPipeline(self, sink, lines, rules, sanitize, code)
+
+    def run(self, text):
+        started = time.perf_counter()
+        stages = []
+        text = self.run_stage("sanitize", SanitizeStage, [(False, text)], stages)[0][1]
+        start = time.perf_counter()
+        segments = self.code_segments(text)
+        if self.skip_code:
+            stages.append(("code", time.perf_counter() - start, len(text), len(text)))
+        for name, build in self.stages(lines=False, rules=self.active_rules(text), sanitize=False):
+            segments = self.run_stage(name, build, segments, stages)
+        text = "".join(piece for _, piece in segments)
+        text = self.run_stage("lines", LineStage, [(False, text)], stages)[0][1]
+        self.metrics.observe_document(stages, time.perf_counter() - started)
+        return text
+
+    @staticmethod
+    def run_stage(name, build, segments, stages):
+        start = time.perf_counter()
+        output = run_segments(build, segments)
+        stages.append((name, time.perf_counter() - start, sum(len(piece) for _, piece in segments),
+                       sum(len(piece) for _, piece in output)))
+        return output
+
+
+class Timer:
+    # In front of a stage of a TimedPipeline: passes every call on and adds
+    # the time spent in the stage itself (the stages it feeds have timers of
+    # their own, whose time is taken off) and the characters it got, which
+    # are also the output of the stage before it (upstream)
+    def __init__(self, pipeline, name, upstream, stage):
+        self.pipeline = pipeline
+        self.stats = pipeline.stats.get(name)
+        self.upstream = pipeline.stats.get(upstream)
+        self.stage = stage
+
+    def timed(self, method, *args):
+        pipeline = self.pipeline
+        outer = pipeline.nested
+        pipeline.nested = 0.0
+        start = time.perf_counter()
+        method(*args)
+        elapsed = time.perf_counter() - start
+        if self.stats is not None:
+            self.stats[0] += elapsed - pipeline.nested
+        pipeline.nested = outer + elapsed
+
+    def feed(self, piece):
+        if self.stats is not None:
+            self.stats[1] += len(piece)
+        if self.upstream is not None:
+            self.upstream[2] += len(piece)
+        self.timed(self.stage.feed, piece)
+
+    def flush(self):
+        self.timed(self.stage.flush)
+
+    def idle(self):
+        return self.stage.idle()
+
+
+class TimedPipeline:
+    # What InstrumentedOptimizer.pipeline returns: the stages of
+    # Optimizer.pipeline, each behind a Timer. flush() ends a document and
+    # records it with the time and characters of every stage and the spans
+    # found since the last one.
+    def __init__(self, optimizer, sink, lines=True, rules=None, sanitize=True, code=True):
+        self.metrics = optimizer.metrics
+        self.nested = 0.0  # time spent in the timers inside the current call
+        self.seconds = 0.0
+        self.tally = {}  # spans found in this document
+        self.taken = {}  # the part of them found() has handed out
+        self.discounted = {}  # spans counted in an earlier document already
+        self.ended = False
+        # The stages call replacement() of the optimizer they are built with,
+        # a copy counting into this pipeline
+        counting = copy.copy(optimizer)
+        counting.tally = self.tally
+        code = code and optimizer.skip_code
+        stages = counting.stages(False, rules, sanitize=False)
+        chain = (["sanitize"] if sanitize else []) + (["code"] if code else []) + [name for name, _ in stages]
+        # [seconds, chars in, chars out] per stage, in pipeline order
+        self.stats = {name: [0.0, 0, 0] for name in chain + (["lines"] if lines else [])}
+
+        # The end of the pipeline is reached from the last rule stage and,
+        # with code, from CodeStage: a timer for each way in
+        if lines:
+            line_stage = LineStage(Timer(self, None, "lines", sink))
+            tail = lambda upstream: Timer(self, "lines", upstream, line_stage)
+        else:
+            tail = lambda upstream: Timer(self, None, upstream, sink)
+        stage = tail(chain[-1] if chain else None)
+        if code:
+            stage = Junction(stage)
+        for index in range(len(stages) - 1, -1, -1):
+            name, build = stages[index]
+            position = len(chain) - len(stages) + index
+            stage = Timer(self, name, chain[position - 1] if position else None, build(stage))
+        if code:
+            stage = Timer(self, "code", "sanitize" if sanitize else None, CodeStage(stage, tail("code")))
+        if sanitize:
+            stage = Timer(self, "sanitize", None, SanitizeStage(stage))
+        self.head = stage
+
+    def feed(self, piece):
+        if self.ended:
+            self.reset()
+        start = time.perf_counter()
+        self.head.feed(piece)
+        self.seconds += time.perf_counter() - start
+
+    def flush(self):
+        if self.ended:
+            self.reset()
+        start = time.perf_counter()
+        self.head.flush()
+        self.seconds += time.perf_counter() - start
+        self.metrics.observe_document([(name,) + tuple(stats) for name, stats in self.stats.items()], self.seconds)
+        for (rule, converted), count in self.tally.items():
+            count -= self.discounted.get((rule, converted), 0)
+            if count > 0:
+                self.metrics.count_span(rule, converted, count)
+        # The tally stays until the next document starts, for found()
+        self.ended = True
+
+    def idle(self):
+        return self.head.idle()
+
+    def reset(self):
+        for stats in self.stats.values():
+            stats[:] = [0.0, 0, 0]
+        self.seconds = 0.0
+        self.tally.clear()
+        self.taken = {}
+        self.discounted = {}
+        self.ended = False
+
+    # The spans found since the last call, e.g. in one run of an IncrementalOptimizer
+    def found(self):
+        spans = {key: count - self.taken.get(key, 0) for key, count in self.tally.items()
+                 if count > self.taken.get(key, 0)}
+        self.taken = dict(self.tally)
+        return spans
+
+    # Spans of an earlier document that this one replaces; the next flush()
+    # only counts the spans found beyond them
+    def discount(self, spans):
+        for key, count in spans.items():
+            self.discounted[key] = self.discounted.get(key, 0) + count
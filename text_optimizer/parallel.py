@@ -0,0 +1,140 @@
+# Optimizing one huge document on several cores.
+#
+# The document is cut into chunks after newlines, preferably at blank lines,
+# and every chunk is optimized on its own as if it started a document. That
+# is right whenever the pipeline holds nothing back at the cut, i.e. no span,
+# $$ region or delimiter is open there; incremental.py relies on the same
+# fact. Whether that was the case is only known once the chunk before has
+# been optimized, so every worker also reports whether its pipeline was idle
+# at the end of its chunk. Chunks after an idle end are taken as they are;
+# after a chunk that ended with something open, the chunks are run again
+# here, in order and with one pipeline, until it is idle at a cut again. The
+# output is therefore always the same as optimize_text, and the parallel part
+# only shrinks when spans do cross the cuts (e.g. a stray "(" in prose,
+# which holds everything after it open until the end).
+#
+# Chunks run on worker processes, or on threads when the interpreter runs
+# without the GIL. The command line drives optimize_parts with its own pool
+# for single large files, with chunks cut from a memory-mapped file and only
+# a few of them in flight at a time.
+import os
+import sys
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from .engine import Collector, default_optimizer, optimize_text, spawn_context, strip_line_ends
+
+# Documents smaller than this are optimized in the calling thread
+MIN_PARALLEL_SIZE = 1024 * 1024
+
+# How far past its target position a cut may move to find a blank line
+BLANK_LINE_WINDOW = 64 * 1024
+
+
+def free_threaded():
+    return not getattr(sys, "_is_gil_enabled", lambda: True)()
+
+
+def decoded(chunk):
+    return chunk.decode("utf-8", "replace") if isinstance(chunk, bytes) else chunk
+
+
+# Runs in the workers: the output of a chunk (a string, or UTF-8 bytes)
+# optimized from the initial state, before the line cleanup, and whether the
+# pipeline was idle at its end
+def optimize_chunk(text, last):
+    text = decoded(text)
+    collector = Collector()
+    pipeline = default_optimizer.pipeline(collector, lines=False)
+    pipeline.feed(text)
+    idle = pipeline.idle()
+    if last:
+        pipeline.flush()
+    return collector.text(), idle
+
+
+# Positions after a newline splitting text into about count chunks; text
+# may also be bytes (or a memory-mapped file) with a newline of b"\n"
+def cut_points(text, count, newline="\n"):
+    cuts = []
+    for index in range(1, count):
+        target = len(text) * index // count
+        if cuts and target <= cuts[-1]:
+            continue
+        blank = text.find(newline * 2, target, target + BLANK_LINE_WINDOW)
+        end = blank if blank >= 0 else text.find(newline, target)
+        if end < 0:
+            break
+        if end + 1 < len(text) and (not cuts or end + 1 > cuts[-1]):
+            cuts.append(end + 1)
+    return cuts
+
+
+class ParallelOptimizer:
+    def __init__(self, workers=None, min_size=MIN_PARALLEL_SIZE, chunks_per_worker=4):
+        self.workers = workers or os.cpu_count() or 1
+        self.min_size = min_size
+        self.chunks_per_worker = chunks_per_worker
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def executor(self):
+        with self.lock:
+            if self.pool is None:
+                if free_threaded():
+                    self.pool = ThreadPoolExecutor(self.workers)
+                else:
+                    self.pool = ProcessPoolExecutor(self.workers, mp_context=spawn_context())
+            return self.pool
+
+    def close(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown()
+                self.pool = None
+
+    def run(self, text):
+        if self.workers == 1 or len(text) < self.min_size:
+            return optimize_text(text)
+        bounds = [0] + cut_points(text, self.workers * self.chunks_per_worker) + [len(text)]
+        parts = optimize_parts(self.executor(), text, bounds, len(bounds))
+        return "".join(parts).rstrip(" \t\n")
+
+
+# Optimize source[bounds[i]:bounds[i + 1]] for every i on executor, with at
+# most in_flight chunks submitted ahead, and yield the output in order, part
+# by part. Every part but the last ends with the newline of its cut, so the
+# line cleanup is done part by part, but for the whitespace at the very end,
+# which the caller strips.
+def optimize_parts(executor, source, bounds, in_flight):
+    count = len(bounds) - 1
+    futures = deque()  # of the chunks from index on
+    submitted = 0
+    index = 0
+    while index < count:
+        while submitted < min(count, index + in_flight):
+            chunk = source[bounds[submitted]:bounds[submitted + 1]]
+            futures.append(executor.submit(optimize_chunk, chunk, submitted == count - 1))
+            submitted += 1
+        output, idle = futures.popleft().result()
+        index += 1
+        if idle or index == count:
+            yield strip_line_ends(output)
+            continue
+        # Something is still open at the end of this chunk: go on with one
+        # pipeline from its start until it is idle at a cut
+        collector = Collector()
+        pipeline = default_optimizer.pipeline(collector, lines=False)
+        pipeline.feed(decoded(source[bounds[index - 1]:bounds[index]]))
+        while index < count:
+            if futures:
+                futures.popleft().cancel()
+            pipeline.feed(decoded(source[bounds[index]:bounds[index + 1]]))
+            index += 1
+            if pipeline.idle():
+                break
+        if index == count:
+            pipeline.flush()
+        submitted = max(submitted, index)
+        yield strip_line_ends(collector.text())
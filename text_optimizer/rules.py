@@ -0,0 +1,49 @@
+# What the optimizer rewrites, as data. The Optimizer in engine.py compiles
+# these tables once and the pipeline stages only look things up in them.
+from collections import namedtuple
+
+# A delimited span that may become Markdown math. Delimiters are one or two
+# characters long.
+#   kind: "inline" ($...$) or "display" ($$...$$)
+#   heuristic: None converts every span, otherwise the name of the check that
+#   decides whether the content is math (see Optimizer.replacement)
+#   not_after: a closer directly preceded by this text does not count
+#   outside: two-character delimiter toggling regions the rule must skip
+Rule = namedtuple("Rule", "name opener closer kind heuristic not_after outside", defaults=(None, None))
+
+# In the order the old passes ran: a rule sees the output of the ones before it
+RULES = (
+    # Standard LaTeX delimiters (used in Grok-like content)
+    Rule("latex_inline", "\\(", "\\)", "inline", None),
+    Rule("latex_display", "\\[", "\\]", "display", None),
+    # ChatGPT-style display math: [ math ], not closed by \big]
+    Rule("chatgpt_display", "[", "]", "display", "display", not_after="\\big"),
+    # ChatGPT-style inline math: ( math ), only outside of $$ ... $$
+    Rule("chatgpt_inline", "(", ")", "inline", "inline", outside="$$"),
+)
+
+# Markdown delimiters for each kind of span
+WRAPPERS = {"inline": "$", "display": "$$"}
+
+# Content likely contains math when it has a LaTeX command (\sum, \log, \big,
+# \hat, \frac, ...) or one of these characters
+MATH_SYMBOLS = "_^{}=<>"
+
+# Cleanups of the content of every converted span, in order: (name, regex,
+# replacement), the replacement is formatted with the named groups of the match
+CONTENT_REWRITES = (
+    # Common copy-paste artifacts from ChatGPT-like content
+    ("artifact", r" ;=; ", " = "),
+    # Leftover semicolons in equations
+    ("semicolon", r";", "="),
+    # Commas that are likely typos in math expressions (e.g., y_i , \log -> y_i \log)
+    ("comma", r"(?P<lead>\w|\}|\d)\s*,\s*(?P<command>\\log|\\sum|\\frac|\\big)", "{lead} {command}"),
+)
+
+# Characters escaped for Markdown compatibility, applied after the rewrites
+ESCAPES = {"_": "\\_"}
+
+# Inline ( ... ) heuristics: longer content is never math, short single words
+# (e.g., variables like y, k) always are
+INLINE_MAX_LENGTH = 100
+INLINE_SHORT_WORD = 10
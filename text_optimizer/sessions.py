@@ -0,0 +1,151 @@
+# Live-edit sessions for the web front-end.
+#
+# Instead of posting the whole document on every keystroke, a client opens a
+# session and sends the edits it made since the revision the server last
+# acknowledged. The server keeps the document and its incremental optimizer
+# state and answers with the Patches that bring the client's copy of the
+# output up to date. Offsets on both sides are UTF-16 code units, as
+# JavaScript counts them.
+#
+# Every edit copies the document, so a request may carry at most max_deltas
+# of them, and they are all applied before the document is optimized again,
+# once. The resulting document must fit in max_bytes, like a posted one.
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from .engine import default_optimizer
+from .incremental import IncrementalOptimizer
+from .workers import MAX_BYTES, LimitExceeded, check_size
+
+# Edits a client may send in one request
+MAX_DELTAS = 100
+
+
+class StaleRevision(Exception):
+    # The client's base revision is not the session's; it has to resend the whole text
+    def __init__(self, revision):
+        super().__init__("session is at revision %d" % revision)
+        self.revision = revision
+
+
+def has_astral(text):
+    return max(text, default="") > "\uffff"
+
+
+# String index of a UTF-16 offset into text
+def utf16_index(text, offset):
+    encoded = text.encode("utf-16-le", "surrogatepass")
+    if not 0 <= 2 * offset <= len(encoded):
+        raise ValueError("offset %d out of range" % offset)
+    return len(encoded[:2 * offset].decode("utf-16-le", "surrogatepass"))
+
+
+class EditSession:
+    def __init__(self, optimizer=default_optimizer, max_bytes=MAX_BYTES, max_deltas=MAX_DELTAS):
+        self.document = IncrementalOptimizer(optimizer, utf16=True)
+        self.max_bytes = max_bytes
+        self.max_deltas = max_deltas
+        self.revision = 0
+        self.astral = False  # the text may have characters outside the BMP, UTF-16 offsets are not indices
+        self.lock = threading.Lock()
+        self.used = time.monotonic()
+
+    # Apply edits [(start, end, text), ...] made in order on top of revision
+    # base; returns the new revision and the output Patches, in order
+    def edit(self, base, deltas):
+        with self.lock:
+            if base != self.revision:
+                raise StaleRevision(self.revision)
+            old = text = self.document.text
+            astral = self.astral
+            try:
+                if len(deltas) > self.max_deltas:
+                    raise LimitExceeded("deltas", "more than %d edits in one request" % self.max_deltas)
+                changed = None  # the edited range so far: start, and the length of the text after it
+                for start, end, inserted in deltas:
+                    if astral:
+                        start, end = utf16_index(text, start), utf16_index(text, end)
+                    if not 0 <= start <= end <= len(text):
+                        raise ValueError("edit %d:%d out of range" % (start, end))
+                    if changed is None:
+                        changed = start, len(text) - end
+                    else:
+                        changed = min(changed[0], start), min(changed[1], len(text) - end)
+                    text = text[:start] + inserted + text[end:]
+                    astral = astral or has_astral(inserted)
+                if changed is None:
+                    return self.advance(), []
+                check_size(text, self.max_bytes)
+                start, after = changed
+                patch = self.document.update(text, start, len(old) - after, len(text) - after)
+            except Exception:
+                # A bad edit, or one over the limits: the document is left as
+                # it was, and moving on makes the client's next edit stale,
+                # so it resends the text
+                self.advance()
+                raise
+            self.astral = astral
+            return self.advance(), [patch]
+
+    # Replace the whole document, e.g. to recover from a StaleRevision;
+    # returns the new revision and the whole output
+    def replace(self, text):
+        with self.lock:
+            try:
+                check_size(text, self.max_bytes)
+                output = self.document.reset(text)
+            except Exception:
+                # The document is not what the client has
+                self.advance()
+                raise
+            self.astral = has_astral(text)
+            return self.advance(), output
+
+    def advance(self):
+        self.revision += 1
+        self.used = time.monotonic()
+        return self.revision
+
+
+class SessionStore:
+    # The most recently used sessions, each dropped after ttl seconds without use
+    def __init__(self, optimizer=default_optimizer, max_sessions=1000, ttl=3600, max_bytes=MAX_BYTES,
+                 max_deltas=MAX_DELTAS):
+        self.optimizer = optimizer
+        self.max_bytes = max_bytes
+        self.max_deltas = max_deltas
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.sessions = OrderedDict()  # id -> EditSession, least recently used first
+        self.lock = threading.Lock()
+
+    def create(self):
+        session_id = secrets.token_urlsafe(16)
+        with self.lock:
+            self.expire()
+            self.sessions[session_id] = EditSession(self.optimizer, self.max_bytes, self.max_deltas)
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+        return session_id
+
+    def get(self, session_id):
+        with self.lock:
+            self.expire()
+            session = self.sessions.get(session_id)
+            if session is not None:
+                session.used = time.monotonic()
+                self.sessions.move_to_end(session_id)
+            return session
+
+    def expire(self):
+        limit = time.monotonic() - self.ttl
+        while self.sessions:
+            session_id, session = next(iter(self.sessions.items()))
+            if session.used >= limit:
+                break
+            del self.sessions[session_id]
+
+    def __len__(self):
+        return len(self.sessions)
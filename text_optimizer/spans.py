@@ -0,0 +1,278 @@
+# Where the math went: a table of the spans converted in a document.
+#
+# trace() optimizes a document like Optimizer.run and also returns, for every
+# span that became Markdown math, its kind, the rule that converted it, where
+# it was in the input and where it is in the output. The stages are run one
+# after another over the whole text (like InstrumentedOptimizer does) with a
+# stand-in for the optimizer that notes the position of every replacement.
+# Each stage only changes the spans it converts, so its positions map to the
+# next stage's by the offsets of those spans; sanitize and the line cleanup
+# only remove runs of characters. A span found by a later stage inside a
+# region an earlier one converted (or the other way round) is covered by
+# that region and not listed on its own, so the table has no overlaps.
+#
+# The table is a set of parallel integer arrays in output order, which is
+# cheap to keep, to send and to walk for clients rendering large documents.
+import bisect
+import re
+import time
+from array import array
+
+from .engine import DELETIONS, Collector, run_segments, sanitize, strip_line_ends
+
+KINDS = ("inline", "display")
+
+ASTRAL = re.compile("[\U00010000-\U0010ffff]")
+
+
+class SpanTable:
+    def __init__(self, rules):
+        self.rules = tuple(rule.name for rule in rules)
+        self.kind = array("b")  # index into KINDS
+        self.rule = array("b")  # index into rules
+        self.source_start = array("q")
+        self.source_end = array("q")
+        self.output_start = array("q")
+        self.output_end = array("q")
+
+    def __len__(self):
+        return len(self.kind)
+
+    def __sizeof__(self):
+        return object.__sizeof__(self) + sum(column.buffer_info()[1] * column.itemsize for column in self.columns())
+
+    def columns(self):
+        return self.kind, self.rule, self.source_start, self.source_end, self.output_start, self.output_end
+
+    def append(self, kind, rule, source_start, source_end, output_start, output_end):
+        for column, value in zip(self.columns(), (kind, rule, source_start, source_end, output_start, output_end)):
+            column.append(value)
+
+    # For JSON responses. Offsets are string indices; given the source and
+    # output texts they are UTF-16 code units instead, as JavaScript counts
+    def to_json(self, source=None, output=None):
+        source_offsets = utf16_offsets(source) if source is not None else None
+        output_offsets = utf16_offsets(output) if output is not None else None
+        return {
+            "kinds": list(KINDS),
+            "rules": list(self.rules),
+            "kind": self.kind.tolist(),
+            "rule": self.rule.tolist(),
+            "source_start": convert(self.source_start, source_offsets),
+            "source_end": convert(self.source_end, source_offsets),
+            "output_start": convert(self.output_start, output_offsets),
+            "output_end": convert(self.output_end, output_offsets),
+        }
+
+
+# Positions of the characters outside the BMP (two UTF-16 code units each),
+# or None if there are none
+def utf16_offsets(text):
+    positions = [match.start() for match in ASTRAL.finditer(text)]
+    return positions or None
+
+
+def convert(column, astral):
+    if astral is None:
+        return column.tolist()
+    return [offset + bisect.bisect_left(astral, offset) for offset in column]
+
+
+class Gaps:
+    # Runs of characters removed from a text, to map positions between the
+    # text before and after the removal
+    def __init__(self, runs=()):
+        self.starts = []
+        self.ends = []
+        self.kept = []  # where each run was, in the text after the removal
+        self.removed = []  # characters removed up to the end of each run
+        total = 0
+        for start, end in runs:
+            self.starts.append(start)
+            self.ends.append(end)
+            self.kept.append(start - total)
+            total += end - start
+            self.removed.append(total)
+
+    def after(self, pos):
+        index = bisect.bisect_right(self.starts, pos) - 1
+        if index < 0:
+            return pos
+        before = self.removed[index - 1] if index else 0
+        return pos - before - (min(pos, self.ends[index]) - self.starts[index])
+
+    # An end position stays right after the character before it, a start
+    # position moves past the runs in front of its character
+    def before(self, pos, end=False):
+        index = (bisect.bisect_left if end else bisect.bisect_right)(self.kept, pos)
+        return pos + (self.removed[index - 1] if index else 0)
+
+
+def sanitize_gaps(raw, text):
+    if len(text) == len(raw):
+        return Gaps()
+    dropped = "".join(char for char in set(raw) if DELETIONS[ord(char)] is None)
+    pattern = re.compile("[" + re.escape(dropped) + "]+")
+    return Gaps(match.span() for match in pattern.finditer(raw))
+
+
+def line_gaps(text):
+    # What LineStage removes: blanks before every newline and all whitespace
+    # at the end
+    body = text.rstrip(" \t\n")
+    runs = []
+    pos = 0
+    for line in body.split("\n")[:-1]:
+        kept = len(line.rstrip(" \t"))
+        if kept < len(line):
+            runs.append((pos + kept, pos + len(line)))
+        pos += len(line) + 1
+    if len(body) < len(text):
+        runs.append((len(body), len(text)))
+    return Gaps(runs)
+
+
+class CountingCollector(Collector):
+    def __init__(self):
+        super().__init__()
+        self.length = 0
+
+    def feed(self, piece):
+        self.length += len(piece)
+        super().feed(piece)
+
+
+class PendingOutput(list):
+    # Stage.out that keeps count of the characters not passed on yet
+    length = 0
+
+    def append(self, piece):
+        self.length += len(piece)
+        super().append(piece)
+
+    def clear(self):
+        self.length = 0
+        super().clear()
+
+
+class Recorder:
+    # Stands in for the optimizer in the stages of a trace and notes every
+    # converted span of the stage running: (rule, input start, input end,
+    # output start, output end)
+    def __init__(self, optimizer):
+        self.optimizer = optimizer
+        self.collector = None
+        self.pending = None  # output of the running stage not in the collector yet
+        self.spans = []
+        self.shift = 0  # output minus input length of the spans so far
+
+    def __getattr__(self, name):
+        return getattr(self.optimizer, name)
+
+    def start(self, collector):
+        self.collector = collector
+        self.spans = []
+        self.shift = 0
+
+    def replacement(self, rule, raw):
+        result = self.optimizer.replacement(rule, raw)
+        if result is not None:
+            # Everything before the span has been emitted, and the stage
+            # passes all text but its spans through unchanged
+            output_start = self.collector.length + self.pending.length
+            input_start = output_start - self.shift
+            input_end = input_start + len(rule.opener) + len(raw) + len(rule.closer)
+            self.spans.append((rule, input_start, input_end, output_start, output_start + len(result)))
+            self.shift += len(result) - (input_end - input_start)
+        return result
+
+
+class StageMap:
+    # Positions through one stage, given the spans it converted
+    def __init__(self, spans):
+        self.input_starts = [span[1] for span in spans]
+        self.input_ends = [span[2] for span in spans]
+        self.output_starts = [span[3] for span in spans]
+        self.output_ends = [span[4] for span in spans]
+
+    # A position inside a converted span moves to its start, or to its end
+    # for end positions
+    @staticmethod
+    def move(pos, end, from_starts, from_ends, to_starts, to_ends):
+        index = bisect.bisect_right(from_starts, pos) - 1
+        if index < 0:
+            return pos
+        if pos >= from_ends[index]:
+            return pos + to_ends[index] - from_ends[index]
+        if pos == from_starts[index] or not end:
+            return to_starts[index]
+        return to_ends[index]
+
+    def forward(self, pos, end=False):
+        return self.move(pos, end, self.input_starts, self.input_ends, self.output_starts, self.output_ends)
+
+    def backward(self, pos, end=False):
+        return self.move(pos, end, self.output_starts, self.output_ends, self.input_starts, self.input_ends)
+
+
+def recorded(build, sink, recorder):
+    stage = build(sink)
+    stage.optimizer = recorder
+    stage.out = recorder.pending = PendingOutput()
+    return stage
+
+
+# Optimize raw like optimizer.run and return (output, SpanTable). A list
+# given as timings gets (stage, seconds, chars in, chars out) of every stage,
+# as InstrumentedOptimizer.run reports them (the seconds include the tracing).
+def trace(optimizer, raw, timings=None):
+    start = time.perf_counter()
+    clean = sanitize(raw)
+    if timings is not None:
+        timings.append(("sanitize", time.perf_counter() - start, len(raw), len(clean)))
+    start = time.perf_counter()
+    segments = optimizer.code_segments(clean)
+    if timings is not None and optimizer.skip_code:
+        timings.append(("code", time.perf_counter() - start, len(clean), len(clean)))
+    recorder = Recorder(optimizer)
+    stages = []
+    for name, build in optimizer.stages(lines=False, rules=optimizer.active_rules(clean), sanitize=False):
+        start = time.perf_counter()
+        chars = sum(len(piece) for _, piece in segments)
+        collector = CountingCollector()
+        recorder.start(collector)
+        segments = run_segments(lambda sink: recorded(build, sink, recorder), segments, collector)
+        stages.append(recorder.spans)
+        if timings is not None:
+            timings.append((name, time.perf_counter() - start, chars, collector.length))
+    start = time.perf_counter()
+    text = "".join(piece for _, piece in segments)
+    output = strip_line_ends(text.rstrip(" \t\n"))
+    if timings is not None:
+        timings.append(("lines", time.perf_counter() - start, len(text), len(output)))
+    lines = line_gaps(text)
+
+    maps = [StageMap(spans) for spans in stages]
+    sources = sanitize_gaps(raw, clean)
+    regions = []
+    for index, spans in enumerate(stages):
+        for rule, input_start, input_end, output_start, output_end in spans:
+            for earlier in reversed(maps[:index]):
+                input_start = earlier.backward(input_start)
+                input_end = earlier.backward(input_end, end=True)
+            for later in maps[index + 1:]:
+                output_start = later.forward(output_start)
+                output_end = later.forward(output_end, end=True)
+            regions.append((lines.after(output_start), -lines.after(output_end), rule,
+                            sources.before(input_start), sources.before(input_end, end=True)))
+
+    table = SpanTable(optimizer.rules)
+    rule_index = {rule: index for index, rule in enumerate(optimizer.rules)}
+    covered = 0
+    for output_start, output_end, rule, source_start, source_end in sorted(regions, key=lambda region: region[:2]):
+        output_end = -output_end
+        if output_start < covered:
+            continue
+        table.append(KINDS.index(rule.kind), rule_index[rule], source_start, source_end, output_start, output_end)
+        covered = output_end
+    return output, table
@@ -0,0 +1,36 @@
+# Optimizing a document while it arrives, e.g. an answer streamed token by
+# token from a chatbot.
+#
+# The pipeline stages already work on pieces: each one passes on what it has
+# decided and holds back only what it cannot decide yet, i.e. a span whose
+# closer has not arrived (an open \(, \[, [ or ( and what followed it), the
+# first character of a possible two-character delimiter, and the whitespace at
+# the end of the text so far, which is dropped if nothing visible follows.
+# With code skipped, the unfinished line is also held from a backtick run not
+# closed yet, or whole while it may be a ``` fence line.
+# A StreamingOptimizer feeds every chunk through and hands out whatever came
+# out at the end, so the output of all feed() calls plus flush() is exactly
+# optimize_text of the whole document, every character is scanned a bounded
+# number of times, and memory is bounded by the longest of these held parts.
+from .engine import Collector, LineStage, default_optimizer
+
+
+class StreamingOptimizer:
+    def __init__(self, optimizer=default_optimizer):
+        self.collector = Collector()
+        # The line cleanup is normally done once at the end of a document,
+        # here it is released after every chunk
+        self.lines = LineStage(self.collector)
+        self.pipeline = optimizer.pipeline(self.lines, lines=False)
+
+    # Optimize the next chunk and return the output that is final by now
+    def feed(self, chunk):
+        self.pipeline.feed(chunk)
+        self.lines.release()
+        return self.collector.text()
+
+    # End the document and return the rest of the output; the optimizer is
+    # then ready for the next document
+    def flush(self):
+        self.pipeline.flush()
+        return self.collector.text()
@@ -0,0 +1,290 @@
+# Optimizing untrusted documents with bounded cost.
+#
+# A server cannot let one paste hold a request thread for as long as it
+# takes. A WorkerPool enforces three limits: the size of a document, the
+# number of spans any one rule may find in it, and the wall time of the
+# optimization. Documents run in a fixed set of long-lived worker processes,
+# one document at a time each; a worker that goes over the time limit is
+# killed and replaced, which is the only way to stop pure-Python code that is
+# in the middle of a document. When every worker is busy for longer than the
+# queue wait, the request is turned away instead of piling up behind them.
+#
+# Documents optimized in the server's own threads (live-edit sessions,
+# streams, small batches) cannot be killed. Their LimitedOptimizer keeps a
+# Budget per document instead: the spans per rule, and the seconds spent
+# optimizing it, checked at every span. The engine is linear and the size of
+# a document is limited, so the spans are where the time can go.
+#
+# With a Metrics registry, the workers measure every document the way
+# InstrumentedOptimizer does and send the stage timings and span counts back
+# with the result, to be recorded in the server's registry.
+import copy
+import os
+import queue
+import time
+
+from .engine import RULES, Optimizer, spawn_context
+from .metrics import InstrumentedOptimizer
+from .spans import trace
+
+# Documents larger than this are rejected, in UTF-8 bytes
+MAX_BYTES = 4 * 1024 * 1024
+
+# Spans a single rule may find in one document
+MAX_MATCHES = 100_000
+
+# Seconds a worker may spend on one document
+TIMEOUT = 5.0
+
+
+class LimitExceeded(Exception):
+    # limit is "bytes", "matches" or "seconds"
+    def __init__(self, limit, message):
+        super().__init__(message)
+        self.limit = limit
+
+
+class Overloaded(Exception):
+    # No worker became free within the queue wait
+    pass
+
+
+def check_size(text, max_bytes):
+    size = len(text.encode("utf-8", "surrogatepass"))
+    if size > max_bytes:
+        raise LimitExceeded("bytes", "document of %d bytes exceeds the limit of %d" % (size, max_bytes))
+
+
+class Budget:
+    # What one document may still use: spans per rule, and seconds of
+    # optimizing. Time only counts between start() and stop(), so a stream
+    # waiting for its next chunk uses none.
+    def __init__(self, max_matches, timeout):
+        self.max_matches = max_matches
+        self.timeout = timeout
+        self.reset()
+
+    def reset(self):
+        self.matches = {}
+        self.left = self.timeout
+        self.deadline = None
+
+    def start(self):
+        if self.left is not None:
+            self.deadline = time.monotonic() + self.left
+
+    def stop(self):
+        if self.deadline is not None:
+            self.left = self.deadline - time.monotonic()
+            self.deadline = None
+
+    def count(self, rule):
+        self.matches[rule.name] = count = self.matches.get(rule.name, 0) + 1
+        if count > self.max_matches:
+            raise LimitExceeded("matches", "more than %d %s spans" % (self.max_matches, rule.name))
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise LimitExceeded("seconds", "not done within %gs" % self.timeout)
+
+
+class LimitedOptimizer(Optimizer):
+    # Raises LimitExceeded once a rule has found more than max_matches spans
+    # in the current document, or, with a timeout, once optimizing it has
+    # taken longer than that many seconds
+    def __init__(self, rules=RULES, max_matches=MAX_MATCHES, skip_code=True, timeout=None):
+        super().__init__(rules, skip_code=skip_code)
+        self.max_matches = max_matches
+        self.timeout = timeout
+        self.budget = None  # the Budget of a pipeline, in the copies pipeline() makes
+
+    def replacement(self, rule, raw):
+        (self.budget or self.local.budget).count(rule)
+        return super().replacement(rule, raw)
+
+    def pipeline(self, sink, lines=True, rules=None, sanitize=True, code=True):
+        # Each pipeline has a budget of its own, the stages count against it
+        limited = copy.copy(self)
+        limited.budget = Budget(self.max_matches, self.timeout)
+        pipeline = super(LimitedOptimizer, limited).pipeline(sink, lines, rules, sanitize, code)
+        return LimitedPipeline(pipeline, limited.budget)
+
+    def run(self, text):
+        self.local.budget = Budget(self.max_matches, self.timeout)
+        self.local.budget.start()
+        return super().run(text)
+
+    def trace(self, text, timings=None):
+        self.local.budget = Budget(self.max_matches, self.timeout)
+        self.local.budget.start()
+        return trace(self, text, timings)
+
+
+class LimitedPipeline:
+    # A pipeline of a LimitedOptimizer: its calls are timed against the
+    # budget, which starts over with every document
+    def __init__(self, pipeline, budget):
+        self.pipeline = pipeline
+        self.budget = budget
+
+    def __getattr__(self, name):
+        return getattr(self.pipeline, name)
+
+    def feed(self, piece):
+        self.budget.start()
+        try:
+            self.pipeline.feed(piece)
+        finally:
+            self.budget.stop()
+
+    def flush(self):
+        self.budget.start()
+        try:
+            self.pipeline.flush()
+        finally:
+            self.budget.reset()
+
+    def idle(self):
+        return self.pipeline.idle()
+
+
+class InstrumentedLimitedOptimizer(LimitedOptimizer, InstrumentedOptimizer):
+    # Limits and instrumentation together; trace() is measured too
+    def __init__(self, rules=RULES, metrics=None, max_matches=MAX_MATCHES, skip_code=True, timeout=None):
+        super().__init__(rules, max_matches, skip_code, timeout)
+        if metrics is not None:
+            self.metrics = metrics
+
+    def trace(self, text, timings=None):
+        started = time.perf_counter()
+        timings = [] if timings is None else timings
+        result = super().trace(text, timings)
+        self.metrics.observe_document(timings, time.perf_counter() - started)
+        return result
+
+
+class Report:
+    # The Metrics registry of a measuring worker: keeps what one document
+    # adds, which is sent back with its result and recorded by the server
+    def __init__(self):
+        self.document = None  # (stages, seconds)
+        self.spans = {}  # (rule, converted) -> count
+
+    def observe_document(self, stages, seconds):
+        self.document = stages, seconds
+
+    def count_span(self, rule, converted, count=1):
+        key = (rule, converted)
+        self.spans[key] = self.spans.get(key, 0) + count
+
+    def record(self, metrics):
+        if self.document is not None:
+            metrics.observe_document(*self.document)
+        for (rule, converted), count in self.spans.items():
+            metrics.count_span(rule, converted, count)
+
+
+# Runs in the worker processes: says when it is ready, then answers every
+# (document, spans) with (output, None, report) or (None, (limit, message),
+# None), where output is (output, SpanTable) when spans is true and report
+# is the document's Report when measuring, else None; a limit of None is
+# any other error
+def serve(connection, max_matches, measure=False):
+    if measure:
+        optimizer = InstrumentedLimitedOptimizer(max_matches=max_matches)
+    else:
+        optimizer = LimitedOptimizer(max_matches=max_matches)
+    connection.send(None)
+    while True:
+        try:
+            text, spans = connection.recv()
+        except EOFError:
+            return
+        report = optimizer.metrics = Report() if measure else None
+        try:
+            result = (optimizer.trace(text) if spans else optimizer.run(text)), None, report
+        except LimitExceeded as error:
+            result = None, (error.limit, str(error)), None
+        except Exception as error:
+            result = None, (None, "%s: %s" % (type(error).__name__, error)), None
+        connection.send(result)
+
+
+class Worker:
+    def __init__(self, context, max_matches, measure=False):
+        self.connection, child = context.Pipe()
+        self.process = context.Process(target=serve, args=(child, max_matches, measure), daemon=True)
+        self.process.start()
+        child.close()
+        # Starting up does not count against the time limit of a document
+        self.connection.recv()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.connection.close()
+
+
+class WorkerPool:
+    # metrics: a Metrics registry for the timings and span counts of the
+    # documents, which the workers then measure
+    def __init__(self, workers=None, timeout=TIMEOUT, max_bytes=MAX_BYTES, max_matches=MAX_MATCHES, wait=None,
+                 metrics=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.max_matches = max_matches
+        self.wait = timeout if wait is None else wait
+        self.metrics = metrics
+        self.context = spawn_context()
+        # Free workers; None is a worker not started yet (or replaced), so
+        # the pool only starts processes once they are needed
+        self.free = queue.LifoQueue()
+        for _ in range(self.workers):
+            self.free.put(None)
+
+    def check_size(self, text):
+        check_size(text, self.max_bytes)
+
+    # The optimized text, or (optimized text, SpanTable) with spans
+    def optimize(self, text, spans=False):
+        self.check_size(text)
+        try:
+            worker = self.free.get(timeout=self.wait)
+        except queue.Empty:
+            raise Overloaded("all %d workers busy for %gs" % (self.workers, self.wait)) from None
+        try:
+            if worker is None:
+                worker = Worker(self.context, self.max_matches, self.metrics is not None)
+            worker.connection.send((text, spans))
+            if not worker.connection.poll(self.timeout):
+                worker.kill()
+                worker = None
+                raise LimitExceeded("seconds", "not done within %gs" % self.timeout)
+            output, error, report = worker.connection.recv()
+        except (EOFError, OSError):
+            # The worker died (e.g. killed for running out of memory)
+            if worker is not None:
+                worker.kill()
+                worker = None
+            raise RuntimeError("worker process died") from None
+        finally:
+            self.free.put(worker)
+        if error is not None:
+            limit, message = error
+            if limit is None:
+                raise RuntimeError(message)
+            raise LimitExceeded(limit, message)
+        if report is not None and self.metrics is not None:
+            report.record(self.metrics)
+        return output
+
+    def close(self):
+        # Stops the workers that are free; busy ones stop once their
+        # connection is closed after the document they are on
+        while True:
+            try:
+                worker = self.free.get_nowait()
+            except queue.Empty:
+                return
+            if worker is not None:
+                worker.connection.close()
+                worker.process.join()